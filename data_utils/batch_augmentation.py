@@ -0,0 +1,294 @@
+#
+# Created  on 2021/3/12
+#
+import math
+import inspect
+
+import numpy as np
+import torch
+import torch.nn.functional as f
+
+from data_utils.dataset_tools import HomographyAugmentation
+
+# 与cv.warpPerspective一致, 像素中心位于整数坐标; 老版本的grid_sample没有align_corners参数, 默认即为True
+_GRID_SAMPLE_KWARGS = {'align_corners': True} if 'align_corners' in inspect.signature(f.grid_sample).parameters else {}
+
+
+class BatchAugmentation(object):
+    """
+    训练时在GPU上对整个batch做光度与单应增强, 代替数据集worker中逐样本的ImgAugTransform与HomographyAugmentation
+    与CPU路径一致: 每个样本以photometric_prob的概率对两幅图像分别做光度增强; 合成样本以homography_prob的概率
+    由单应变换生成第二幅图像, 并重新得到对应的warped_heatmap, warped_point_mask, warped_desp_point, valid_mask与not_search_mask
+    光度增强的参数与ImgAugTransform的默认参数一致, 只在最后量化一次到uint8
+    """
+
+    def __init__(self, device, height, width,
+                 photometric_prob=0.5,
+                 homography_prob=0.5,
+                 max_abs_change=50,
+                 strength_range=(0.5, 1.5),
+                 stddev_range=(0, 10),
+                 prob_range=(0, 0.0035),
+                 motion_blur_prob=0.5,
+                 motion_blur_kernel_size=3,
+                 threshold=16,
+                 ):
+        self.device = device
+        self.height = height
+        self.width = width
+        self.photometric_prob = photometric_prob
+        self.homography_prob = homography_prob
+        self.max_abs_change = max_abs_change
+        self.strength_range = strength_range
+        self.stddev_range = stddev_range
+        self.prob_range = prob_range
+        self.motion_blur_prob = motion_blur_prob
+        self.motion_blur_kernel_size = motion_blur_kernel_size
+        self.threshold = threshold
+        self.homography = HomographyAugmentation()
+
+        ys, xs = torch.meshgrid(torch.arange(height, dtype=torch.float), torch.arange(width, dtype=torch.float))
+        self.pixel_coords = torch.stack((xs, ys, torch.ones_like(xs)), dim=0).reshape((3, -1)).to(device)  # [3,h*w]
+
+    def __call__(self, data):
+        """
+        Args:
+            data: 已拷贝到device上的batch, 除MegaDepthTrainDataset的输出外还需要gpu_augmentation模式下的
+                point: [b,m,2] y,x顺序的关键点, 以nan补齐
+                is_synthesis: [b] 合成样本为1
+        Returns:
+            data: 原地修改后的batch
+        """
+        batch_size = data['image'].shape[0]
+        image = (data['image'] + 1.) * 127.5  # 还原到[0,255]
+        warped_image = (data['warped_image'] + 1.) * 127.5
+        changed = torch.zeros((batch_size,), dtype=torch.bool, device=self.device)
+
+        # 1、合成样本由单应变换生成第二幅图像, 与CPU路径相同, 单应变换在光度增强之前
+        warp_mask = (data['is_synthesis'] > 0) & (torch.rand((batch_size,), device=self.device) < self.homography_prob)
+        warp_idx = torch.nonzero(warp_mask).reshape((-1,))
+        if warp_idx.shape[0] > 0:
+            homography = self.homography.sample_batch(self.height, self.width, warp_idx.shape[0])
+            homography = torch.from_numpy(homography).to(self.device)  # float64
+            warped_image[warp_idx], data['warped_point_mask'][warp_idx] = self._warp_image(image[warp_idx], homography)
+            data['warped_heatmap'][warp_idx] = self._warp_heatmap(data['point'][warp_idx], homography)
+            warped_desp_point, valid_mask, not_search_mask = self._warp_desp_point(
+                data['desp_point'][warp_idx], homography)
+            data['warped_desp_point'][warp_idx] = warped_desp_point
+            data['valid_mask'][warp_idx] = valid_mask
+            data['not_search_mask'][warp_idx] = not_search_mask
+            changed[warp_idx] = True
+
+        # 2、光度增强, 同一样本的两幅图像使用各自的随机参数
+        photo_idx = torch.nonzero(torch.rand((batch_size,), device=self.device) < self.photometric_prob).reshape((-1,))
+        if photo_idx.shape[0] > 0:
+            image[photo_idx] = self._photometric(image[photo_idx])
+            warped_image[photo_idx] = self._photometric(warped_image[photo_idx])
+            changed[photo_idx] = True
+
+        # 3、与数据集一致, 量化为uint8后再归一化到[-1,1]; 未增强的样本保持不变
+        changed_idx = torch.nonzero(changed).reshape((-1,))
+        if changed_idx.shape[0] > 0:
+            data['image'][changed_idx] = torch.round(image[changed_idx]) * 2. / 255. - 1.
+            data['warped_image'][changed_idx] = torch.round(warped_image[changed_idx]) * 2. / 255. - 1.
+        return data
+
+    def _warp_image(self, image, homography):
+        """
+        与cv.warpPerspective(image, homography)一致的双线性变换, 以及由全1图像变换得到的有效区域掩膜
+        Args:
+            image: [k,c,h,w]
+            homography: [k,3,3] float64
+        Returns:
+            warped_image: [k,c,h,w]
+            warped_mask: [k,h,w]
+        """
+        k = image.shape[0]
+        inv_homography = torch.inverse(homography).to(torch.float)
+        src = torch.matmul(inv_homography, self.pixel_coords)  # [k,3,h*w]
+        src = src[:, :2, :] / src[:, 2:3, :]
+        scale = torch.tensor((self.width - 1, self.height - 1), dtype=torch.float, device=self.device)
+        grid = (src.transpose(1, 2) * 2. / scale - 1.).reshape((k, self.height, self.width, 2))
+
+        warped_image = f.grid_sample(image, grid, mode='bilinear', padding_mode='zeros', **_GRID_SAMPLE_KWARGS)
+        ones = torch.ones((k, 1, self.height, self.width), dtype=image.dtype, device=self.device)
+        warped_mask = f.grid_sample(ones, grid, mode='bilinear', padding_mode='zeros', **_GRID_SAMPLE_KWARGS)
+        return warped_image, warped_mask[:, 0]
+
+    def _warp_heatmap(self, point, homography):
+        """
+        与HomographyAugmentation.warp_keypoints及_convert_points_to_heatmap一致: 变换关键点, 去掉图像外的点后取整置1
+        Args:
+            point: [k,m,2] y,x顺序, nan为补齐的点
+            homography: [k,3,3] float64
+        Returns:
+            heatmap: [k,h,w]
+        """
+        k, m, _ = point.shape
+        point = torch.cat((point.flip(dims=[2]).to(torch.double),
+                           torch.ones((k, m, 1), dtype=torch.double, device=self.device)), dim=2)
+        project_point = torch.matmul(point, homography.transpose(1, 2)).to(torch.float)
+        project_point = (project_point[:, :, :2] / project_point[:, :, 2:]).flip(dims=[2])  # y,x
+
+        # 先按亚像素位置去掉图像外的点, 再取整
+        valid = (project_point[:, :, 0] >= 0) & (project_point[:, :, 0] <= self.height - 1) & \
+                (project_point[:, :, 1] >= 0) & (project_point[:, :, 1] <= self.width - 1)
+        batch_idx, point_idx = torch.nonzero(valid).t()
+        project_point = torch.round(project_point[batch_idx, point_idx]).to(torch.long)
+
+        heatmap = torch.zeros((k, self.height, self.width), dtype=torch.float, device=self.device)
+        heatmap.index_put_((batch_idx, project_point[:, 0], project_point[:, 1]),
+                           torch.ones((batch_idx.shape[0],), device=self.device))
+        return heatmap
+
+    def _warp_desp_point(self, desp_point, homography):
+        """
+        与MegaDepthTrainDataset._generate_warped_point一致, 得到变换后的描述子采样点、有效关系及不参与负样本搜索的矩阵
+        Args:
+            desp_point: [k,n,1,2] x,y顺序, 范围[-1,1]
+            homography: [k,3,3] float64
+        Returns:
+            warped_desp_point: [k,n,1,2] x,y顺序, 范围[-1,1]
+            valid_mask: [k,n]
+            not_search_mask: [k,n,n]
+        """
+        k, n = desp_point.shape[:2]
+        size = torch.tensor((self.width - 1, self.height - 1), dtype=torch.double, device=self.device)
+        point = (desp_point[:, :, 0, :].to(torch.double) + 1.) * size / 2.  # x,y像素坐标
+        point = torch.cat((point, torch.ones((k, n, 1), dtype=torch.double, device=self.device)), dim=2)
+        project_point = torch.matmul(point, homography.transpose(1, 2))
+        project_point = project_point[:, :, :2] / project_point[:, :, 2:]  # x,y
+
+        valid_mask = (project_point >= 0).all(dim=2) & (project_point <= size).all(dim=2)
+        dist = torch.norm(project_point[:, :, None, :] - project_point[:, None, :, :], dim=3)
+        not_search_mask = (dist <= self.threshold) | (~valid_mask)[:, None, :]
+
+        warped_desp_point = (project_point.to(torch.float) * 2. / size.to(torch.float) - 1.)[:, :, None, :]
+        return warped_desp_point, valid_mask.to(torch.float), not_search_mask.to(torch.float)
+
+    def _photometric(self, image):
+        """
+        依次为亮度、对比度、高斯噪声、椒盐噪声与运动模糊, 对应ImgAugTransform中的Add, LinearContrast,
+        AdditiveGaussianNoise, ImpulseNoise与Sometimes(0.5, MotionBlur)
+        Args:
+            image: [k,c,h,w] 范围[0,255]
+        """
+        k = image.shape[0]
+        image = self._brightness(image)
+        image = self._contrast(image)
+        image = self._gaussian_noise(image)
+        image = self._impulse_noise(image)
+
+        blur_idx = torch.nonzero(torch.rand((k,), device=self.device) < self.motion_blur_prob).reshape((-1,))
+        if blur_idx.shape[0] > 0:
+            image[blur_idx] = self._motion_blur(image[blur_idx])
+        return image
+
+    def _brightness(self, image):
+        k = image.shape[0]
+        delta = torch.randint(-self.max_abs_change, self.max_abs_change + 1, (k, 1, 1, 1), device=self.device)
+        return torch.clamp(image + delta.to(image.dtype), 0, 255)
+
+    def _contrast(self, image):
+        k = image.shape[0]
+        alpha = torch.empty((k, 1, 1, 1), device=self.device).uniform_(*self.strength_range)
+        return torch.clamp(127.5 + alpha * (image - 127.5), 0, 255)
+
+    def _gaussian_noise(self, image):
+        # 各通道共用同一噪声
+        k, c, h, w = image.shape
+        stddev = torch.empty((k, 1, 1, 1), device=self.device).uniform_(*self.stddev_range)
+        return torch.clamp(image + torch.randn((k, 1, h, w), device=self.device) * stddev, 0, 255)
+
+    def _impulse_noise(self, image):
+        # 每个通道单独置为0或255
+        k, c, h, w = image.shape
+        prob = torch.empty((k, 1, 1, 1), device=self.device).uniform_(*self.prob_range)
+        impulse = torch.rand((k, c, h, w), device=self.device) < prob
+        salt = torch.rand((k, c, h, w), device=self.device) < 0.5
+        return torch.where(impulse, salt.to(image.dtype) * 255., image)
+
+    def _motion_blur(self, image):
+        """
+        与imgaug的MotionBlur一致: 中间一列按方向线性加权的核, 随机旋转后归一化, 各图像的核逐图像分组卷积
+        """
+        k, c, h, w = image.shape
+        ksize = self.motion_blur_kernel_size
+        device = self.device
+
+        direction = (torch.empty((k,), device=device).uniform_(-1, 1) + 1.) / 2.
+        steps = torch.linspace(0, 1, ksize, device=device)
+        kernel = torch.zeros((k, 1, ksize, ksize), device=device)
+        kernel[:, 0, :, ksize // 2] = direction[:, None] + (1. - 2. * direction[:, None]) * steps[None, :]
+
+        angle = torch.empty((k,), device=device).uniform_(0, 2 * math.pi)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        zeros = torch.zeros_like(angle)
+        theta = torch.stack((cos, -sin, zeros, sin, cos, zeros), dim=1).reshape((k, 2, 3))
+        grid = f.affine_grid(theta, [k, 1, ksize, ksize], **_GRID_SAMPLE_KWARGS)
+        kernel = f.grid_sample(kernel, grid, mode='bilinear', padding_mode='zeros', **_GRID_SAMPLE_KWARGS)
+        kernel = kernel / torch.sum(kernel, dim=(2, 3), keepdim=True)
+
+        pad = ksize // 2
+        image = f.pad(image.reshape((1, k * c, h, w)), (pad, pad, pad, pad), mode='reflect')
+        image = f.conv2d(image, kernel.repeat_interleave(c, dim=0), groups=k * c)
+        return image.reshape((k, c, h, w))
+
+
+def compare_photometric(image, trials=200):
+    """
+    在同一幅图像上重复增强, 比较BatchAugmentation的各光度增强与ImgAugTransform中对应的imgaug算子的输出统计, 需要安装imgaug
+    Args:
+        image: [h,w,3] uint8 RGB图像
+    Returns:
+        stats: {op: {'imgaug': [3], 'gpu': [3]}}, 依次为各次输出像素均值的平均、各次输出像素均值的标准差、各次输出像素标准差的平均
+    """
+    from imgaug import augmenters as iaa
+    from data_utils.dataset_tools import ImgAugTransform
+
+    height, width = image.shape[:2]
+    augmentation = BatchAugmentation(torch.device('cpu'), height, width)
+    ops = [
+        ('add', iaa.Add((-augmentation.max_abs_change, augmentation.max_abs_change)), augmentation._brightness),
+        ('linear_contrast', iaa.LinearContrast(augmentation.strength_range), augmentation._contrast),
+        ('gaussian_noise', iaa.AdditiveGaussianNoise(scale=augmentation.stddev_range), augmentation._gaussian_noise),
+        ('impulse_noise', iaa.ImpulseNoise(p=augmentation.prob_range), augmentation._impulse_noise),
+        ('motion_blur', iaa.MotionBlur(augmentation.motion_blur_kernel_size), augmentation._motion_blur),
+        ('all', ImgAugTransform().aug, augmentation._photometric),
+    ]
+
+    def _summary(images):
+        images = images.reshape((images.shape[0], -1)).astype(np.float64)
+        means, stds = np.mean(images, axis=1), np.std(images, axis=1)
+        return np.array((np.mean(means), np.std(means), np.mean(stds)))
+
+    batch = torch.from_numpy(image).permute(2, 0, 1).to(torch.float)[None].repeat(trials, 1, 1, 1)
+    stats = {}
+    for name, imgaug_op, gpu_op in ops:
+        imgaug_images = np.stack([imgaug_op.augment_image(image) for _ in range(trials)])
+        gpu_images = torch.clamp(torch.round(gpu_op(batch.clone())), 0, 255).numpy()
+        stats[name] = {'imgaug': _summary(imgaug_images), 'gpu': _summary(gpu_images)}
+    return stats
+
+
+if __name__ == '__main__':
+    # 光度增强与imgaug的统计对比: python -m data_utils.batch_augmentation [--image path]
+    import argparse
+    import cv2 as cv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', type=str, default='', help='default to a fixed random textured image')
+    parser.add_argument('--trials', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.image:
+        image = cv.imread(args.image)[:, :, ::-1].copy()
+    else:
+        rng = np.random.RandomState(0)
+        image = cv.resize(rng.randint(0, 256, (30, 40, 3)).astype(np.uint8), (320, 240), interpolation=cv.INTER_LINEAR)
+
+    torch.manual_seed(0)
+    stats = compare_photometric(image, trials=args.trials)
+    print('%-16s %24s %24s' % ('op', 'imgaug mean/std(mean)/std', 'gpu mean/std(mean)/std'))
+    for name, item in stats.items():
+        print('%-16s %8.2f %7.2f %7.2f %8.2f %7.2f %7.2f' % ((name,) + tuple(item['imgaug']) + tuple(item['gpu'])))
@@ -264,7 +264,8 @@ class HomographyAugmentation(object):
                  do_rotation=True,
                  do_translation=True,
                  allow_artifacts=True,
-                 rotation=None
+                 rotation=None,
+                 num_candidates=16
                  ):
         self.patch_ratio = patch_ratio
         self.perspective_amplitude_x = perspective_amplitude_x
@@ -287,24 +288,22 @@ class HomographyAugmentation(object):
             self.do_rotation = False
         self.do_translation = do_translation
         self.allow_artifacts = allow_artifacts
+        # required_point_num时一次采样的候选单应变换个数
+        self.num_candidates = num_candidates
+        # 各步骤的候选总数、其中有效的个数以及没有有效候选时退回默认候选的次数, 每个进程单独统计
+        self.stats = {name: {'candidates': 0, 'valid': 0, 'fallback': 0}
+                      for name in ['scaling', 'rotation', 'point_num']}
 
     def __call__(self, image, points, mask=None, return_homo=False, required_point_num=False, required_num=100):
         shape = image.shape
         h, w = shape[0], shape[1]
-        homography = self.sample(height=h, width=w)
         if required_point_num:
+            homography = self._sample_with_point_num(points, h, w, required_num)
             warped_points, warped_idx = self.warp_keypoints(points, homography, height=h, width=w, filter_org=True)
-            while True:
-                if warped_points.shape[0] >= required_num:
-                    break
-                else:
-                    homography = self.sample(height=h, width=w)
-                    warped_points, warped_idx = self.warp_keypoints(points, homography, height=h, width=w, filter_org=True)
-            points_same_with_warp = []
-            for idx in warped_idx:
-                points_same_with_warp.append(points[idx])
-            points = np.stack(points_same_with_warp, axis=0)
+            # 所有候选都不保留任何点时warped_idx为空, 此时返回[0,2]的空点集
+            points = points[warped_idx]
         else:
+            homography = self.sample(height=h, width=w)
             warped_points = self.warp_keypoints(points, homography, height=h, width=w)
 
         if mask is None:
@@ -355,6 +354,8 @@ class HomographyAugmentation(object):
         """
         n, _ = points.shape
         if n == 0:
+            if filter_org:
+                return points, np.zeros((0,), dtype=np.int64)
             return points
         points = np.flip(points, axis=1)
         points = np.concatenate((points, np.ones((n, 1))), axis=1)[:, :, np.newaxis]
@@ -385,13 +386,66 @@ class HomographyAugmentation(object):
         else:
             return in_points
 
+    def _sample_with_point_num(self, points, height, width, required_num):
+        """
+        一次采样num_candidates个单应变换, 取第一个使变换后仍在图像内的点数不少于required_num的;
+        都不满足时退回保留点数最多的一个(可能一个点也不保留), 不再无限重试
+        """
+        homography = self.sample_batch(height, width, self.num_candidates)  # [k,3,3]
+        points = np.concatenate((points[:, ::-1], np.ones((points.shape[0], 1))), axis=1)  # [n,3] x,y,1
+        project_point = np.matmul(points[np.newaxis], homography.transpose((0, 2, 1))).astype(np.float32)
+        project_point = project_point[:, :, :2] / project_point[:, :, 2:]  # [k,n,2] x,y
+        boarder = np.array((width - 1, height - 1), dtype=np.float32)
+        point_num = np.sum(np.all((project_point >= 0) & (project_point <= boarder), axis=2), axis=1)
+
+        valid = point_num >= required_num
+        self._update_stats('point_num', valid[np.newaxis])
+        if np.any(valid):
+            return homography[np.argmax(valid)]
+        return homography[np.argmax(point_num)]
+
+    def _update_stats(self, name, valid):
+        self.stats[name]['candidates'] += valid.size
+        self.stats[name]['valid'] += int(np.sum(valid))
+        self.stats[name]['fallback'] += int(np.sum(~np.any(valid, axis=1)))
+
+    def acceptance_stats(self):
+        """
+        各步骤候选的接受率, 以及没有有效候选而退回默认候选的次数
+        """
+        return {name: {'acceptance': stat['valid'] / max(stat['candidates'], 1), 'fallback': stat['fallback']}
+                for name, stat in self.stats.items()}
+
+    def _choose_valid(self, name, valid):
+        """
+        在每行有效的候选中等概率地选择一个, 不做拒绝重采样; 一行中没有有效候选时选择最后一个(不缩放/不旋转)
+        Args:
+            valid: [b,k] bool
+        Returns:
+            idx: [b]
+        """
+        self._update_stats(name, valid)
+        scores = np.where(valid, torch.rand(valid.shape, dtype=torch.double).numpy(), -1.)
+        scores[~np.any(valid, axis=1), -1] = 0.
+        return np.argmax(scores, axis=1)
+
     def sample(self, height, width):
+        return self.sample_batch(height, width, 1)[0]
 
-        pts_1 = np.array(((0, 0), (0, 1), (1, 1), (1, 0)), dtype=np.float)  # 注意这里第一维是x，第二维是y
+    def sample_batch(self, height, width, batch_size=1):
+        """
+        一次向量化地采样batch_size个单应变换, 尺度与旋转的所有候选一起生成并检查边界, 8x8方程组批量求解
+        Returns:
+            homography: [batch_size,3,3]
+        """
+        b = batch_size
+        batch_idx = np.arange(b)
+        pts_1 = np.array(((0, 0), (0, 1), (1, 1), (1, 0)), dtype=np.float64)  # 注意这里第一维是x，第二维是y
         margin = (1 - self.patch_ratio) / 2
         pts_2 = margin + np.array(((0, 0), (0, self.patch_ratio),
                                    (self.patch_ratio, self.patch_ratio), (self.patch_ratio, 0)),
-                                  dtype=np.float)
+                                  dtype=np.float64)
+        pts_2 = np.tile(pts_2[np.newaxis], (b, 1, 1))  # [b,4,2]
 
         # 进行透视变换
         if self.do_perspective:
@@ -400,97 +454,84 @@ class HomographyAugmentation(object):
             if not self.allow_artifacts:
                 perspective_amplitude_x = min(self.perspective_amplitude_x, margin)
                 perspective_amplitude_y = min(self.perspective_amplitude_y, margin)
-            tmp_tensor = torch.ones([], dtype=torch.float)
-            y_displacement = tmp_tensor.uniform_(-perspective_amplitude_y, perspective_amplitude_y).item()
-            x_displacement_left = tmp_tensor.uniform_(-perspective_amplitude_x, perspective_amplitude_x).item()
-            x_displacement_right = tmp_tensor.uniform_(-perspective_amplitude_x, perspective_amplitude_x).item()
-            # y_displacement = np.random.uniform(-perspective_amplitude_y, perspective_amplitude_y)
-            # x_displacement_left = np.random.uniform(-perspective_amplitude_x, perspective_amplitude_x)
-            # x_displacement_right = np.random.uniform(-perspective_amplitude_x, perspective_amplitude_x)
-
-            pts_2 += np.array(((x_displacement_left, y_displacement),
-                               (x_displacement_left, -y_displacement),
-                               (x_displacement_right, y_displacement),
-                               (x_displacement_right, -y_displacement)))
+            # 每行依次为y_displacement, x_displacement_left, x_displacement_right
+            rand = torch.rand((b, 3), dtype=torch.double).numpy() * 2 - 1
+            pts_2[:, :, 0] += rand[:, [1, 1, 2, 2]] * perspective_amplitude_x
+            pts_2[:, :, 1] += rand[:, [0]] * np.array((1, -1, 1, -1)) * perspective_amplitude_y
 
         # 进行尺度变换
         if self.do_scaling:
-            # 得到n+1个尺度参数，其中最后一个为1，即不进行尺度化
-            random_scales = torch.ones((self.scaling_sample_num,), dtype=torch.float).uniform_(
-                self.scaling_low, self.scaling_up).numpy()
-            scales = np.concatenate((random_scales, np.ones((1,))), axis=0)
-            # scales = np.concatenate((np.random.uniform(1-self.scaling_amplitude, 1+self.scaling_amplitude,
-            #                                            size=(self.scaling_sample_num,)),
-            #                          np.ones((1,))), axis=0)
-            # 中心点不变的尺度缩放
-            center = np.mean(pts_2, axis=0, keepdims=True)
-            scaled = np.expand_dims(pts_2 - center, axis=0) * np.expand_dims(np.expand_dims(scales, 1), 1) + center
+            # 每个样本n+1个尺度参数，其中最后一个为1，即不进行尺度化
+            random_scales = self.scaling_low + torch.rand((b, self.scaling_sample_num), dtype=torch.double).numpy() * (
+                self.scaling_up - self.scaling_low)
+            scales = np.concatenate((random_scales, np.ones((b, 1))), axis=1)
+            # 中心点不变的尺度缩放, [b,n+1,4,2]
+            center = np.mean(pts_2, axis=1, keepdims=True)
+            scaled = (pts_2 - center)[:, np.newaxis] * scales[:, :, np.newaxis, np.newaxis] + center[:, np.newaxis]
             if self.allow_artifacts:
-                valid = np.arange(self.scaling_sample_num + 1)
+                valid = np.ones(scales.shape, dtype=bool)
             else:
-                valid = np.where(np.all((scaled >= 0.) & (scaled < 1.), axis=(1, 2)))[0]
-            random_idx = torch.randint(0, valid.shape[0], size=[]).item()
-            idx = valid[random_idx]
-            # idx = valid[np.random.randint(0, valid.shape[0])]
-            # 从n_scales个随机的缩放中随机地取一个出来
-            pts_2 = scaled[idx]
+                valid = np.all((scaled >= 0.) & (scaled < 1.), axis=(2, 3))
+            pts_2 = scaled[batch_idx, self._choose_valid('scaling', valid)]
 
         # 进行平移变换
         if self.do_translation:
-            t_min, t_max = np.min(np.abs(pts_2), axis=0), np.min(np.abs(1 - pts_2), axis=0)
-            # t_min, t_max = np.min(pts_2, axis=0), np.min(1 - pts_2, axis=0)
+            t_min, t_max = np.min(np.abs(pts_2), axis=1), np.min(np.abs(1 - pts_2), axis=1)  # [b,2]
             if self.allow_artifacts:
                 t_min += self.translation_overflow
                 t_max += self.translation_overflow
-            random_t_0 = torch.ones([]).uniform_(-t_min[0], t_max[0]).item()
-            random_t_1 = torch.ones([]).uniform_(-t_min[1], t_max[1]).item()
-            pts_2 += np.expand_dims(np.stack((random_t_0, random_t_1)), axis=0)
-            # pts_2 += np.expand_dims(np.stack((np.random.uniform(-t_min[0], t_max[0]),
-            #                                   np.random.uniform(-t_min[1], t_max[1]))), axis=0)
+            rand = torch.rand((b, 2), dtype=torch.double).numpy()
+            pts_2 += (rand * (t_min + t_max) - t_min)[:, np.newaxis, :]
 
         if self.do_rotation:
-            angles = torch.ones((self.rotation_sample_num,), dtype=torch.float).uniform_(
-                self.rotation_min_angle, self.rotation_max_angle).numpy()
-            # angles = np.linspace(-self.rotation_max_angle, self.rotation_max_angle, self.rotation_sample_num)
-            # angles = np.random.uniform(-self.rotation_max_angle, self.rotation_max_angle, self.rotation_sample_num)
-            angles = np.concatenate((angles, np.zeros((1,))), axis=0)  # in case no rotation is valid
-            center = np.mean(pts_2, axis=0, keepdims=True)
-            rot_mat = np.reshape(np.stack((np.cos(angles), -np.sin(angles),
-                                           np.sin(angles), np.cos(angles)), axis=1), newshape=(-1, 2, 2))
+            angles = self.rotation_min_angle + torch.rand((b, self.rotation_sample_num), dtype=torch.double).numpy() * (
+                self.rotation_max_angle - self.rotation_min_angle)
+            angles = np.concatenate((angles, np.zeros((b, 1))), axis=1)  # in case no rotation is valid
+            center = np.mean(pts_2, axis=1, keepdims=True)
             # [x, y] * | cos -sin|
             #          | sin  cos|
-            rotated = np.matmul(
-                np.tile(np.expand_dims(pts_2 - center, axis=0), reps=(self.rotation_sample_num + 1, 1, 1)), rot_mat
-            ) + center
+            rot_mat = np.empty(angles.shape + (2, 2))
+            rot_mat[:, :, 0, 0] = rot_mat[:, :, 1, 1] = np.cos(angles)
+            rot_mat[:, :, 1, 0] = np.sin(angles)
+            rot_mat[:, :, 0, 1] = -rot_mat[:, :, 1, 0]
+            rotated = np.matmul((pts_2 - center)[:, np.newaxis, :, :], rot_mat) + center[:, np.newaxis]  # [b,n+1,4,2]
             if self.allow_artifacts:
-                valid = np.arange(self.rotation_sample_num)
+                valid = np.ones(angles.shape, dtype=bool)
+                valid[:, -1] = False
             else:
                 # 得到未超边界值的idx
-                valid = np.where(np.all((rotated >= 0.) & (rotated < 1.), axis=(1, 2)))[0]
-            random_idx = torch.randint(0, valid.shape[0], size=[]).item()
-            idx = valid[random_idx]
-            # idx = valid[np.random.randint(0, valid.shape[0])]
-            pts_2 = rotated[idx]
-
-        def mat(p, q):
-            coefficient_mat = np.empty((8, 8), dtype=np.float)
-            for i in range(4):
-                coefficient_mat[i, :] = [p[i][0], p[i][1], 1, 0, 0, 0, -p[i][0] * q[i][0], -p[i][1] * q[i][0]]
-            for i in range(4):
-                coefficient_mat[i + 4, :] = [0, 0, 0, p[i][0], p[i][1], 1, -p[i][0] * q[i][1], -p[i][1] * q[i][1]]
-            return coefficient_mat
+                valid = np.all((rotated >= 0.) & (rotated < 1.), axis=(2, 3))
+            pts_2 = rotated[batch_idx, self._choose_valid('rotation', valid)]
 
         # 将矩形以及变换后的四边形坐标还原到实际尺度上，并计算他们之间对应的单应变换
-        size = np.array((width - 1, height - 1), dtype=np.float)
-        pts_1 *= size
-        pts_2 *= size
+        size = np.array((width - 1, height - 1), dtype=np.float64)
+        return self._solve_homography(pts_1 * size, pts_2 * size)
 
-        a_mat = mat(pts_1, pts_2)
-        b_mat = np.concatenate(np.split(pts_2, 2, axis=1), axis=0)
-        homography = np.linalg.lstsq(a_mat, b_mat, None)[0].reshape((8,))
-        homography = np.concatenate((homography, np.ones((1,))), axis=0).reshape((3, 3))
-
-        return homography
+    @staticmethod
+    def _solve_homography(pts_1, pts_2):
+        """
+        由四组对应点批量求解单应变换
+        Args:
+            pts_1: [4,2] 或 [b,4,2]
+            pts_2: [b,4,2]
+        Returns:
+            homography: [b,3,3]
+        """
+        b = pts_2.shape[0]
+        p = np.broadcast_to(pts_1, pts_2.shape)
+        q = pts_2
+        # 前4行为[x, y, 1, 0, 0, 0, -x*x', -y*x'], 后4行为[0, 0, 0, x, y, 1, -x*y', -y*y']
+        a_mat = np.zeros((b, 8, 8))
+        a_mat[:, :4, 0:2] = p
+        a_mat[:, :4, 2] = 1
+        a_mat[:, 4:, 3:5] = p
+        a_mat[:, 4:, 5] = 1
+        a_mat[:, :4, 6:8] = -p * q[:, :, 0:1]
+        a_mat[:, 4:, 6:8] = -p * q[:, :, 1:2]
+        b_mat = q.transpose((0, 2, 1)).reshape((b, 8, 1))  # [x'0..x'3, y'0..y'3]
+        homography = np.ones((b, 9))
+        homography[:, :8] = np.linalg.solve(a_mat, b_mat)[:, :, 0]
+        return homography.reshape((b, 3, 3))
 
 
 class PhotometricAugmentation(object):
@@ -763,6 +804,32 @@ def space_to_depth(org_tensor, patch_height=8, patch_width=8):
     return new_tensor
 
 
+def pack_bitmask(mask):
+    """
+    将[n,m]的0/1掩膜按行压缩为位图, 每个元素占1bit, 体积为float32的1/32
+    Args:
+        mask: [n,m] bool或0/1的float
+    Returns:
+        bits: [n,ceil(m/8)] uint8, 与np.packbits的位序一致(高位在前)
+    """
+    return np.packbits(np.asarray(mask) != 0, axis=1)
+
+
+def unpack_bitmask(bits, num):
+    """
+    pack_bitmask的逆过程, 在bits所在的设备上展开, 用于训练时在GPU上还原not_search_mask
+    Args:
+        bits: [...,n,ceil(num/8)] uint8 tensor
+        num: 掩膜的列数
+    Returns:
+        mask: [...,n,num] float32, 置位处为1
+    """
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=bits.device)
+    mask = (bits.unsqueeze(-1) >> shifts) & 1
+    mask = mask.reshape(bits.shape[:-1] + (bits.shape[-1] * 8,))[..., :num]
+    return mask.to(torch.float)
+
+
 def draw_image_keypoints(image, points, color=(0, 255, 0), show=True):
     """
     将输入的关键点画到图像上并显示出来
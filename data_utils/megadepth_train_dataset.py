@@ -8,23 +8,28 @@ import cv2 as cv
 import numpy as np
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+from scipy.spatial import cKDTree
 
 from data_utils.dataset_tools import HomographyAugmentation
 from data_utils.dataset_tools import ImgAugTransform
 from data_utils.dataset_tools import space_to_depth
+from data_utils.dataset_tools import pack_bitmask
 class MegaDepthTrainDataset(Dataset):
     """
     Combination of MegaDetph and COCO
     """
     def __init__(self, **config):
-        self.data_list = self._format_file_list(
-            config['mega_image_dir'],
-            config['mega_keypoint_dir'],
-            config['mega_despoint_dir'],
-        )
+        self.data_list = self._get_data_list(config)
         self.sydesp_type=config['sydesp_type']
+        # dense: [n,n] float32的not_search_mask; bitset: [n,ceil(n/8)] uint8的not_search_bits, 训练时在GPU上展开
+        self.not_search_encoding = config.get('not_search_encoding', 'dense')
+        if self.not_search_encoding not in ['dense', 'bitset']:
+            assert False
         self.height = config['height']
         self.width = config['width']
+        # 为True时worker中不做光度与单应增强, 由训练器中的BatchAugmentation在GPU上对整个batch完成
+        self.gpu_augmentation = config.get('gpu_augmentation', False)
 
         self.homography = HomographyAugmentation()
         self.photometric = ImgAugTransform()
@@ -33,6 +38,24 @@ class MegaDepthTrainDataset(Dataset):
     def __len__(self):
         return len(self.data_list)
 
+    def _get_data_list(self, config):
+        return self._format_file_list(
+            config['mega_image_dir'],
+            config['mega_keypoint_dir'],
+            config['mega_despoint_dir'],
+        )
+
+    def _load_sample(self, data_info):
+        """
+        读取一个样本的原始数据
+        Returns:
+            image12: [h,2w,3] 左右拼接的RGB图像对
+            label: 包含points_0, points_1的关键点标签
+            info: 包含desp_point1, desp_point2, valid_mask, not_search_mask, raw_desp_point1, raw_desp_point2
+        """
+        image12 = cv.imread(data_info['image'])[:, :, ::-1].copy()  # 交换BGR为RGB
+        return image12, np.load(data_info['label']), np.load(data_info['info'])
+
     def __getitem__(self, idx):
         data_info = self.data_list[idx]
         if data_info['type'] == 'synthesis':
@@ -43,25 +66,18 @@ class MegaDepthTrainDataset(Dataset):
             assert False
 
     def _get_real_data(self, data_info):
-        image_dir = data_info['image']
-        info_dir = data_info['info']
-        label_dir = data_info['label']
-
-        image12 = cv.imread(image_dir)[:, :, ::-1].copy()  # 交换BGR为RGB
+        image12, label, info = self._load_sample(data_info)
         image1, image2 = np.split(image12, 2, axis=1)
         h, w, _ = image1.shape
 
-        if torch.rand([]).item() < 0.5:
+        if not self.gpu_augmentation and torch.rand([]).item() < 0.5:
             image1 = self.photometric(image1)
             image2 = self.photometric(image2)
 
-        info = np.load(info_dir)
         desp_point1 = info["desp_point1"]
         desp_point2 = info["desp_point2"]
         valid_mask = info["valid_mask"]
-        not_search_mask = info["not_search_mask"]
 
-        label = np.load(label_dir)
         points1 = label["points_0"]
         points2 = label["points_1"]
 
@@ -92,9 +108,8 @@ class MegaDepthTrainDataset(Dataset):
         desp_point2 = torch.from_numpy(desp_point2)
 
         valid_mask = torch.from_numpy(valid_mask).to(torch.float)
-        not_search_mask = torch.from_numpy(not_search_mask).to(torch.float)
 
-        return {
+        data = {
             "image": image1,
             "point_mask": point_mask1,
             "heatmap": heatmap1,
@@ -104,14 +119,31 @@ class MegaDepthTrainDataset(Dataset):
             "desp_point": desp_point1,
             "warped_desp_point": desp_point2,
             "valid_mask": valid_mask,
-            "not_search_mask": not_search_mask,
         }
+        data.update(self._load_not_search_mask(info))
+        if self.gpu_augmentation:
+            data.update({"point": torch.zeros((0, 2)), "is_synthesis": torch.tensor(0.)})
+        return data
+
+    def _load_not_search_mask(self, info):
+        """
+        按not_search_encoding读取not_search_mask, 打包时已存为位图的info中为not_search_bits
+        """
+        if "not_search_bits" in info:
+            bits = np.asarray(info["not_search_bits"])
+            if self.not_search_encoding == 'bitset':
+                return {"not_search_bits": torch.from_numpy(bits.copy())}
+            num = bits.shape[0]
+            not_search_mask = np.unpackbits(bits, axis=1)[:, :num]
+        else:
+            not_search_mask = info["not_search_mask"]
+            if self.not_search_encoding == 'bitset':
+                return {"not_search_bits": torch.from_numpy(pack_bitmask(not_search_mask))}
+        return {"not_search_mask": torch.from_numpy(not_search_mask).to(torch.float)}
 
     def _get_synthesis_data(self, data_info):
-        image12 = cv.imread(data_info['image'])[:, :, ::-1].copy()  # 交换BGR为RGB
+        image12, point, info = self._load_sample(data_info)
         image1, image2 = np.split(image12, 2, axis=1)
-        point = np.load(data_info['label'])
-        info = np.load(data_info['info'])
         if torch.rand([]).item() < 0.5:
             image = cv.resize(image1, dsize=(self.width, self.height), interpolation=cv.INTER_LINEAR)
             point = point["points_0"]
@@ -123,14 +155,14 @@ class MegaDepthTrainDataset(Dataset):
         point_mask = np.ones_like(image).astype(np.float32)[:, :, 0].copy()
 
         # 1、由随机采样的单应变换得到第二副图像及其对应的关键点位置、原始掩膜和该单应变换
-        if torch.rand([]).item() < 0.5:
+        if self.gpu_augmentation or torch.rand([]).item() < 0.5:
             warped_image, warped_point_mask, warped_point, homography = \
                 image.copy(), point_mask.copy(), point.copy(), np.eye(3)
         else:
             warped_image, warped_point_mask, warped_point, homography = self.homography(image, point, return_homo=True)
             warped_point_mask = warped_point_mask[:, :, 0].copy()
 
-        if torch.rand([]).item() < 0.5:
+        if not self.gpu_augmentation and torch.rand([]).item() < 0.5:
             image = self.photometric(image)
             warped_image = self.photometric(warped_image)
 
@@ -149,7 +181,7 @@ class MegaDepthTrainDataset(Dataset):
         shape = image.shape
 
         warped_desp_point, valid_mask, not_search_mask = self._generate_warped_point(
-            desp_point, homography, shape[0], shape[1])
+            desp_point, homography, shape[0], shape[1], encoding=self.not_search_encoding)
 
         # debug use
         # image_point = draw_image_keypoints(image, desp_point, show=False)
@@ -174,8 +206,9 @@ class MegaDepthTrainDataset(Dataset):
 
         valid_mask = torch.from_numpy(valid_mask)
         not_search_mask = torch.from_numpy(not_search_mask)
+        not_search_key = "not_search_mask" if self.not_search_encoding == 'dense' else "not_search_bits"
 
-        return {
+        data = {
             "image": image,  # [1,h,w]
             "point_mask": point_mask,  # [h,w]
             "heatmap": heatmap,  # [h,w]
@@ -185,19 +218,41 @@ class MegaDepthTrainDataset(Dataset):
             "desp_point": desp_point,  # [n,1,2]
             "warped_desp_point": warped_desp_point,  # [n,1,2]
             "valid_mask": valid_mask,  # [n]
-            "not_search_mask": not_search_mask,  # [n,n]
+            not_search_key: not_search_mask,  # [n,n] float32 或 [n,ceil(n/8)] uint8
         }
+        if self.gpu_augmentation:
+            data.update({
+                "point": torch.from_numpy(np.asarray(point, dtype=np.float32).reshape((-1, 2))),  # [m,2]
+                "is_synthesis": torch.tensor(1.),
+            })
+        return data
+
+    @staticmethod
+    def collate_fn(batch):
+        """
+        gpu_augmentation时各样本的关键点数目不同, 以nan补齐为[b,max_m,2], 其余与default_collate一致
+        """
+        if "point" not in batch[0]:
+            return default_collate(batch)
+        max_num = max(sample["point"].shape[0] for sample in batch)
+        padded = torch.full((len(batch), max_num, 2), float('nan'))
+        for i, sample in enumerate(batch):
+            padded[i, :sample["point"].shape[0]] = sample["point"]
+        data = default_collate([{k: v for k, v in sample.items() if k != "point"} for sample in batch])
+        data["point"] = padded
+        return data
 
     @ staticmethod
-    def _generate_warped_point(point, homography, height, width, threshold=16):
+    def _generate_warped_point(point, homography, height, width, threshold=16, encoding='dense'):
         """
         根据投影变换得到变换后的坐标点，有效关系及不参与负样本搜索的矩阵
         Args:
             point: [n,2] 与warped_point一一对应
             homography: 点对之间的变换关系
+            encoding: dense 或 bitset
 
         Returns:
-            not_search_mask: [n,n] type为float32的mask,不搜索的位置为1
+            not_search_mask: [n,n] type为float32的mask,不搜索的位置为1; bitset时为pack_bitmask压缩后的[n,ceil(n/8)] uint8
         """
         # 得到投影点的坐标
         point = np.concatenate((point[:, ::-1], np.ones((point.shape[0], 1))), axis=1)[:, :, np.newaxis]  # [n,3,1]
@@ -212,10 +267,22 @@ class MegaDepthTrainDataset(Dataset):
         valid_mask = np.all(valid_mask, axis=1)
         invalid_mask = ~valid_mask
 
-        # 根据无效点及投影点之间的距离关系确定不搜索的负样本矩阵
-
-        dist = np.linalg.norm(project_point[:, np.newaxis, :] - project_point[np.newaxis, :, :], axis=2)
-        not_search_mask = ((dist <= threshold) | invalid_mask[np.newaxis, :]).astype(np.float32)
+        # 根据无效点及投影点之间的距离关系确定不搜索的负样本矩阵, 近邻由kd树得到, 不再计算n*n的距离矩阵
+        num = project_point.shape[0]
+        not_search_mask = np.zeros((num, num), dtype=bool)
+        finite_idx = np.nonzero(np.all(np.isfinite(project_point), axis=1))[0]
+        not_search_mask[finite_idx, finite_idx] = True
+        if finite_idx.shape[0] > 1:
+            pairs = cKDTree(project_point[finite_idx]).query_pairs(threshold, output_type='ndarray')
+            pairs = finite_idx[pairs]
+            not_search_mask[pairs[:, 0], pairs[:, 1]] = True
+            not_search_mask[pairs[:, 1], pairs[:, 0]] = True
+        not_search_mask[:, invalid_mask] = True
+
+        if encoding == 'dense':
+            not_search_mask = not_search_mask.astype(np.float32)
+        else:
+            not_search_mask = pack_bitmask(not_search_mask)
         return project_point.astype(np.float32), valid_mask.astype(np.float32), not_search_mask
 
     def _scale_point_for_sample(self, point):
@@ -290,31 +357,17 @@ class MegaDepthTrainDataset(Dataset):
         height = self.height
         width = self.width
 
-        # localmap = self.localmap.clone()
-        # padded_heatmap = torch.zeros(
-        #     (height+self.g_paddings*2, width+self.g_paddings*2), dtype=torch.float)
         heatmap = torch.zeros((height, width), dtype=torch.float)
 
-        num_pt = points.shape[0]
-        if num_pt > 0:
-            for i in range(num_pt):
-                pt = points[i]
-                pt_y_float, pt_x_float = pt
-
-                pt_y_int = round(pt_y_float)
-                pt_x_int = round(pt_x_float)
-
-                pt_y = int(pt_y_int)  # 对真值点位置进行下采样,这里有量化误差
-                pt_x = int(pt_x_int)
-
-                # 排除掉经下采样后在边界外的点
-                if pt_y < 0 or pt_y > height - 1:
-                    continue
-                if pt_x < 0 or pt_x > width - 1:
-                    continue
+        if points.shape[0] > 0:
+            # 与逐点的round一致, np.rint同样是四舍六入五成双, 量化后排除在边界外的点
+            points = np.rint(np.asarray(points, dtype=np.float64).reshape((-1, 2)))
+            valid = (points[:, 0] >= 0) & (points[:, 0] <= height - 1) & \
+                    (points[:, 1] >= 0) & (points[:, 1] <= width - 1)
+            points = torch.from_numpy(points[valid].astype(np.int64))
 
-                # 关键点位置在heatmap上置1，并在incmap上记录该点离亚像素点的偏移量
-                heatmap[pt_y, pt_x] = 1.0
+            # 关键点位置在heatmap上置1, 重复的点写入同一位置
+            heatmap.index_put_((points[:, 0], points[:, 1]), torch.ones(points.shape[0]))
 
         return heatmap
 
@@ -379,7 +432,33 @@ class MegaDepthTrainDataset(Dataset):
         return data_list
 
 
+if __name__ == '__main__':
+    # 热图光栅化的单进程吞吐量, 每个样本调用两次: python -m data_utils.megadepth_train_dataset
+    import time
 
+    def convert_points_to_heatmap_loop(points, height, width):
+        heatmap = torch.zeros((height, width), dtype=torch.float)
+        for i in range(points.shape[0]):
+            pt_y = int(round(points[i][0]))
+            pt_x = int(round(points[i][1]))
+            if pt_y < 0 or pt_y > height - 1 or pt_x < 0 or pt_x > width - 1:
+                continue
+            heatmap[pt_y, pt_x] = 1.0
+        return heatmap
 
-
-
+    dataset = MegaDepthTrainDataset(mega_image_dir='', mega_keypoint_dir='', mega_despoint_dir='',
+                                    sydesp_type='random', height=400, width=400)
+    rng = np.random.RandomState(0)
+    samples = [rng.uniform(-10, 410, size=(2, num, 2)).astype(np.float32) for num in rng.randint(500, 3000, 50)]
+
+    for name, convert in [('loop', lambda p: convert_points_to_heatmap_loop(p, 400, 400)),
+                          ('vectorized', dataset._convert_points_to_heatmap)]:
+        start_time = time.time()
+        for points1, points2 in samples:
+            convert(points1)
+            convert(points2)
+        print('%s: %.1f samples/s per worker' % (name, len(samples) / (time.time() - start_time)))
+
+    for points1, _ in samples:
+        assert torch.equal(convert_points_to_heatmap_loop(points1, 400, 400),
+                           dataset._convert_points_to_heatmap(points1))
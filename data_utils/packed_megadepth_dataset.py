@@ -0,0 +1,217 @@
+#
+# Created  on 2021/3/10
+#
+import os
+import json
+import argparse
+
+import yaml
+import cv2 as cv
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from data_utils.megadepth_train_dataset import MegaDepthTrainDataset
+from data_utils.dataset_tools import pack_bitmask
+
+
+class ShardWriter(object):
+    """
+    将MegaDepth训练样本打包为固定样本数的分片文件<pack_dir>/shard_%05d.bin
+    每个样本的所有数组连续存放(按ALIGN字节对齐), 读取一个样本只需要一次顺序读; 所有样本的位置记录在<pack_dir>/index.json:
+        {"image_format": ..., "samples_per_shard": ..., "shards": [...],
+         "records": [{"name": ..., "shard": i, "offset": ..., "size": ..., "fields": {name: [offset, dtype, shape]}}]}
+    fields中的offset相对于样本起始位置, image字段在image_format为jpg时存放原始jpeg字节, 为raw时存放解码后的RGB图像
+    """
+    ALIGN = 64
+
+    def __init__(self, pack_dir, samples_per_shard=1024, image_format='jpg'):
+        if image_format not in ['jpg', 'raw']:
+            assert False
+        self.pack_dir = str(pack_dir)
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self.samples_per_shard = samples_per_shard
+        self.image_format = image_format
+        self.shards = []
+        self.records = []
+        self.shard_file = None
+        self.offset = 0
+
+    def _next_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        shard_name = 'shard_%05d.bin' % len(self.shards)
+        self.shards.append(shard_name)
+        self.shard_file = open(os.path.join(self.pack_dir, shard_name), 'wb')
+        self.offset = 0
+
+    def append(self, name, image_path, label, info):
+        if len(self.records) % self.samples_per_shard == 0:
+            self._next_shard()
+
+        if self.image_format == 'jpg':
+            with open(image_path, 'rb') as f:
+                image = np.frombuffer(f.read(), dtype=np.uint8)
+        else:
+            image = cv.imread(image_path)[:, :, ::-1]
+
+        arrays = {'image': image}
+        arrays.update({'label/' + key: label[key] for key in label.keys()})
+        arrays.update({'info/' + key: info[key] for key in info.keys()})
+
+        fields = {}
+        size = 0
+        chunks = []
+        for key, value in arrays.items():
+            value = np.ascontiguousarray(value)
+            pad = (-size) % self.ALIGN
+            chunks.append(b'\0' * pad)
+            size += pad
+            fields[key] = [size, value.dtype.str, list(value.shape)]
+            chunks.append(value.tobytes())
+            size += value.nbytes
+        size += (-size) % self.ALIGN
+        chunks.append(b'\0' * (size - sum(len(c) for c in chunks)))
+
+        self.shard_file.write(b''.join(chunks))
+        self.records.append({'name': name, 'shard': len(self.shards) - 1, 'offset': self.offset,
+                             'size': size, 'fields': fields})
+        self.offset += size
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        # 分片全部写完后再写索引, 中断的打包不会留下可用的索引
+        index_path = os.path.join(self.pack_dir, 'index.json')
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'image_format': self.image_format, 'samples_per_shard': self.samples_per_shard,
+                       'shards': self.shards, 'records': self.records}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def pack_megadepth(mega_image_dir, mega_keypoint_dir, mega_despoint_dir, pack_dir,
+                   samples_per_shard=1024, image_format='jpg', not_search_encoding='dense'):
+    """
+    离线打包MegaDepthTrainDataset用到的所有文件, 每个图像对的jpg与两个npz只打包一次
+    not_search_encoding为bitset时, n*n的not_search_mask以pack_bitmask压缩后的not_search_bits存放
+    """
+    data_list = MegaDepthTrainDataset._format_file_list(mega_image_dir, mega_keypoint_dir, mega_despoint_dir)
+    data_list = [data_info for data_info in data_list if data_info['type'] == 'real']
+    with ShardWriter(pack_dir, samples_per_shard=samples_per_shard, image_format=image_format) as writer:
+        for i, data_info in enumerate(data_list):
+            name = data_info['image'].split('/')[-1].split('.')[0]
+            with np.load(data_info['label']) as label, np.load(data_info['info']) as info:
+                info = {key: info[key] for key in info.keys()}
+                if not_search_encoding == 'bitset' and 'not_search_mask' in info:
+                    info['not_search_bits'] = pack_bitmask(info.pop('not_search_mask'))
+                writer.append(name, data_info['image'], label, info)
+            if (i + 1) % 1000 == 0:
+                print('packed %d/%d' % (i + 1, len(data_list)))
+    return len(data_list)
+
+
+class ShardSampler(Sampler):
+    """
+    每个epoch打乱分片的顺序, 分片内部再打乱样本, 使同一时间读取的样本集中在一个分片内
+    """
+
+    def __init__(self, shard_groups):
+        self.shard_groups = shard_groups
+
+    def __len__(self):
+        return sum(len(group) for group in self.shard_groups)
+
+    def __iter__(self):
+        for shard_idx in torch.randperm(len(self.shard_groups)).tolist():
+            group = self.shard_groups[shard_idx]
+            for i in torch.randperm(len(group)).tolist():
+                yield group[i]
+
+
+class PackedMegaDepthTrainDataset(MegaDepthTrainDataset):
+    """
+    读取pack_megadepth打包后的分片, 样本内容与MegaDepthTrainDataset一致
+    启动时只读取index.json, 不再glob整个目录; 每个样本一次read, 不再打开三个小文件
+    """
+
+    def __init__(self, **config):
+        self.pack_dir = config['mega_pack_dir']
+        self.shard_file = None
+        self.shard_idx = None
+        self.pid = None
+        super(PackedMegaDepthTrainDataset, self).__init__(**config)
+
+    def _get_data_list(self, config):
+        with open(os.path.join(self.pack_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.image_format = index['image_format']
+        self.shards = index['shards']
+        self.records = index['records']
+
+        # 与_format_file_list相同的顺序: 先是所有real样本, 再是所有synthesis样本
+        data_list = []
+        for data_type in ['real', 'synthesis']:
+            for i in range(len(self.records)):
+                data_list.append({'type': data_type, 'record': i})
+        return data_list
+
+    def shard_sampler(self):
+        shard_groups = [[] for _ in self.shards]
+        for idx, data_info in enumerate(self.data_list):
+            shard_groups[self.records[data_info['record']]['shard']].append(idx)
+        return ShardSampler(shard_groups)
+
+    def _read_record(self, record):
+        # DataLoader的每个worker各自打开文件, 不与fork前的父进程共享文件偏移
+        if self.pid != os.getpid() or self.shard_idx != record['shard']:
+            if self.shard_file is not None and self.pid == os.getpid():
+                self.shard_file.close()
+            self.shard_file = open(os.path.join(self.pack_dir, self.shards[record['shard']]), 'rb', buffering=0)
+            self.shard_idx = record['shard']
+            self.pid = os.getpid()
+
+        buffer = bytearray(record['size'])
+        self.shard_file.seek(record['offset'])
+        self.shard_file.readinto(buffer)
+
+        arrays = {}
+        for key, (offset, dtype, shape) in record['fields'].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            arrays[key] = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+        return arrays
+
+    def _load_sample(self, data_info):
+        arrays = self._read_record(self.records[data_info['record']])
+        if self.image_format == 'jpg':
+            image12 = cv.imdecode(arrays['image'], cv.IMREAD_COLOR)[:, :, ::-1].copy()  # 交换BGR为RGB
+        else:
+            image12 = arrays['image']
+        label = {key[len('label/'):]: value for key, value in arrays.items() if key.startswith('label/')}
+        info = {key[len('info/'):]: value for key, value in arrays.items() if key.startswith('info/')}
+        return image12, label, info
+
+
+if __name__ == '__main__':
+    # 离线打包: python -m data_utils.packed_megadepth_dataset --configs configs/MTLDesc_train.yaml
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, default='configs/MTLDesc_train.yaml')
+    parser.add_argument('--output', type=str, default='', help='default to train.mega_pack_dir in the config')
+    parser.add_argument('--samples-per-shard', type=int, default=1024)
+    parser.add_argument('--image-format', type=str, default='jpg', choices=['jpg', 'raw'])
+    parser.add_argument('--not-search-encoding', type=str, default='bitset', choices=['dense', 'bitset'])
+    args = parser.parse_args()
+
+    with open(args.configs, 'r') as f:
+        config = yaml.load(f)['train']
+    pack_dir = args.output if args.output else config['mega_pack_dir']
+    num = pack_megadepth(config['mega_image_dir'], config['mega_keypoint_dir'], config['mega_despoint_dir'],
+                         pack_dir, samples_per_shard=args.samples_per_shard, image_format=args.image_format,
+                         not_search_encoding=args.not_search_encoding)
+    print('packed %d image pairs to %s' % (num, pack_dir))
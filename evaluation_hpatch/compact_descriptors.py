@@ -0,0 +1,97 @@
+#
+# Created  on 2021/3/4
+#
+import os
+import argparse
+
+import numpy as np
+
+from utils.evaluator import Evaluator, FeatureReader, evaluate
+from utils.descriptor_codec import ENCODINGS, encode_descriptors, decode_descriptors, encoded_bytes
+from utils.descriptor_codec import fit_pca, save_pca, load_pca
+
+
+def sample_descriptors(reader, dataset_path, samples_per_image=200, seed=0):
+    """
+    从导出的特征中为每幅图像随机采样samples_per_image个描述子
+    """
+    rng = np.random.RandomState(seed)
+    samples = []
+    for seq_name in sorted(os.listdir(dataset_path)):
+        for im_idx in range(1, 7):
+            _, _, descs = reader(seq_name, im_idx)
+            if descs.shape[0] > samples_per_image:
+                descs = descs[np.sort(rng.choice(descs.shape[0], samples_per_image, replace=False))]
+            samples.append(np.asarray(descs, dtype=np.float32))
+    return np.concatenate(samples, axis=0)
+
+
+def generate_read_function(reader, encoding, pca, stats):
+    def read_function(seq_name, im_idx):
+        shape, kpts, descs = reader(seq_name, im_idx)
+        encoded = encode_descriptors(descs, encoding, pca)
+        stats['bytes'] += encoded_bytes(encoded)
+        stats['num'] += descs.shape[0]
+        return shape, kpts, decode_descriptors(encoded, pca)
+    return read_function
+
+
+def accuracy_report(reader, dataset_path, encodings, pca=None):
+    """
+    对每种编码先编码再解码描述子后跑一遍HPatches评测, 返回每种编码的平均字节数及各阈值下的MMA
+    """
+    report = {}
+    for encoding in encodings:
+        stats = {'bytes': 0, 'num': 0}
+        evaluator = Evaluator()
+        evaluate(generate_read_function(reader, encoding, pca, stats), dataset_path, evaluator)
+        all_eval_stats = evaluator.stats['all_eval_stats']
+        mma = all_eval_stats[:, 6] / max(all_eval_stats[0, 0], 1)
+        report[encoding] = {
+            'bytes_per_descriptor': stats['bytes'] / max(stats['num'], 1),
+            'MMA': {thr: mma[i] for i, thr in enumerate(evaluator.err_thld)},
+        }
+    return report
+
+
+def print_report(report):
+    base = report.get('float32')
+    print('%-8s %10s %8s %8s %8s %8s' % ('encoding', 'bytes/desc', 'MMA@1', 'MMA@3', 'MMA@5', 'MMA@10'))
+    for encoding, item in report.items():
+        mma = item['MMA']
+        print('%-8s %10.1f %8.4f %8.4f %8.4f %8.4f' % (
+            encoding, item['bytes_per_descriptor'], mma[1], mma[3], mma[5], mma[10]))
+        if base is not None and encoding != 'float32':
+            print('%-8s %10s %+8.4f %+8.4f %+8.4f %+8.4f' % (
+                '', 'delta', mma[1] - base['MMA'][1], mma[3] - base['MMA'][3],
+                mma[5] - base['MMA'][5], mma[10] - base['MMA'][10]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=['fit', 'report'])
+    parser.add_argument('--features', type=str, required=True, help='<tag>.feats store or the exported sequence root')
+    parser.add_argument('--tag', type=str, default='mtldesc')
+    parser.add_argument('--dataset', type=str, default='hpatches_sequences/hpatches-sequences-release')
+    parser.add_argument('--pca', type=str, default='')
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--samples-per-image', type=int, default=200)
+    parser.add_argument('--encodings', type=str, default=','.join(ENCODINGS))
+    args = parser.parse_args()
+
+    # 评测时读取的是float32原始描述子, 编码在read_function中完成
+    reader = FeatureReader(args.features, tag=args.tag)
+
+    if args.command == 'fit':
+        samples = sample_descriptors(reader, args.dataset, samples_per_image=args.samples_per_image)
+        pca = fit_pca(samples, args.dim)
+        save_pca(args.pca, pca)
+        print('fit pca %d -> %d on %d descriptors, saved to %s' % (
+            samples.shape[1], args.dim, samples.shape[0], args.pca))
+    else:
+        encodings = args.encodings.split(',')
+        pca = load_pca(args.pca) if args.pca else None
+        if pca is None and 'pca' in encodings:
+            print('no --pca given, skip pca encoding')
+            encodings.remove('pca')
+        print_report(accuracy_report(reader, args.dataset, encodings, pca=pca))
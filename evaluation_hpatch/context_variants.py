@@ -0,0 +1,99 @@
+#
+# Created  on 2021/3/8
+#
+import time
+import argparse
+from pathlib import Path
+
+import yaml
+import torch
+
+from hpatch_related.hpatch_dataset import OrgHPatchDataset
+from utils.feature_store import FeatureStoreWriter
+from utils.evaluator import Evaluator, FeatureReader, evaluate
+from models import get_model
+from export import extract_singlescale
+
+
+def context_latency(net, repeat=50):
+    """
+    全局上下文transformer在64x64 adapool特征上的单次前向延迟(秒)
+    """
+    transformer = net.model.transfomer.eval()
+    inputs = torch.randn(1, 128, net.model.pool_size, net.model.pool_size, device=net.device)
+    with torch.no_grad():
+        for _ in range(5):
+            transformer(inputs)
+        start_time = time.time()
+        for _ in range(repeat):
+            transformer(inputs)
+    return (time.time() - start_time) / repeat
+
+
+def export_variant(net, dataset, path, top_k):
+    """
+    导出一个变体在HPatches上的特征, 返回每幅图像的平均提取时间(秒)
+    """
+    elapsed = 0.
+    with FeatureStoreWriter(path) as store:
+        for data in dataset:
+            start_time = time.time()
+            predictions = extract_singlescale(net, data['image'], top_k=top_k)
+            elapsed += time.time() - start_time
+            store.append(data['folder_name'], data['image_name'], predictions)
+    return elapsed / max(len(dataset), 1)
+
+
+def print_report(report):
+    print('%-12s %6s %6s %12s %10s %8s %8s %8s %8s' % (
+        'variant', 'layers', 'mlp', 'context(ms)', 'image(ms)', 'MMA@1', 'MMA@3', 'MMA@5', 'MMA@10'))
+    for name, item in report.items():
+        mma = item['MMA']
+        print('%-12s %6d %6d %12.2f %10.1f %8.4f %8.4f %8.4f %8.4f' % (
+            name, item['layers'], item['mlp'], item['context_latency'] * 1000, item['image_latency'] * 1000,
+            mma[1], mma[3], mma[5], mma[10]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='latency / HPatches MMA of global context transformer variants')
+    parser.add_argument('--config', type=str, default='../configs/MTLDesc_eva.yaml')
+    parser.add_argument('--output_root', type=str, default='hpatches_sequences/context_variants')
+    parser.add_argument('--top-k', type=int, default=10000)
+    parser.add_argument('--variant', nargs=5, action='append', required=True,
+                        metavar=('NAME', 'LAYERS', 'MLP_DIM', 'CKPT_NAME', 'WEIGHTS_ID'),
+                        help='e.g. --variant base 12 2048 mtldesc 29 --variant l4 4 512 mtl_distill_l4 04')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.load(f)
+    output_root = Path(args.output_root)
+    output_root.mkdir(parents=True, exist_ok=True)
+    dataset = OrgHPatchDataset(**config['hpatches'])
+
+    report = {}
+    for name, layers, mlp_dim, ckpt_name, weights_id in args.variant:
+        model_config = dict(config['model'])
+        model_config.update(context_layers=int(layers), context_mlp_dim=int(mlp_dim),
+                            ckpt_name=ckpt_name, weights_id=weights_id)
+        with get_model(model_config['name'])(**model_config) as net:
+            net.model.eval()
+            latency = context_latency(net)
+            feats_path = Path(output_root, name + '.feats')
+            for path in [feats_path, Path(str(feats_path) + '.index')]:
+                if path.exists():
+                    path.unlink()
+            image_latency = export_variant(net, dataset, feats_path, args.top_k)
+
+        evaluator = Evaluator()
+        evaluate(FeatureReader(feats_path), config['hpatches']['dataset_dir'], evaluator)
+        all_eval_stats = evaluator.stats['all_eval_stats']
+        mma = all_eval_stats[:, 6] / max(all_eval_stats[0, 0], 1)
+        report[name] = {
+            'layers': int(layers),
+            'mlp': int(mlp_dim),
+            'context_latency': latency,
+            'image_latency': image_latency,
+            'MMA': {thr: mma[i] for i, thr in enumerate(evaluator.err_thld)},
+        }
+
+    print_report(report)
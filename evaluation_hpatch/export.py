@@ -2,6 +2,8 @@
 # Created  on 2020/6/27
 #
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
 import yaml
@@ -9,9 +11,12 @@ import numpy as np
 from tqdm import tqdm
 
 from hpatch_related.hpatch_dataset import OrgHPatchDataset
+from utils.feature_store import FeatureStoreWriter
+from utils.descriptor_codec import ENCODINGS, encode_descriptors, load_pca
 from models import get_model
 import cv2 as cv
 import torch
+from torch.utils.data import DataLoader
 import time
 def average_inference_time(time_collect):
     average_time = sum(time_collect) / len(time_collect)
@@ -42,7 +47,7 @@ def extract_multiscale(net, img, scale_f=2 ** 0.25,
             # extract descriptors
 
             with torch.no_grad():
-                res = net.predict(img=img)
+                res = net.predict(img=img, top_k=top_k)
             x = res['keypoints'][:,0]
             y = res['keypoints'][:,1]
             d = res['descriptors']
@@ -74,6 +79,46 @@ def extract_multiscale(net, img, scale_f=2 ** 0.25,
     }
 
     return predictions
+def extract_pyramid(net, img, scale_f=2 ** 0.25,
+                    min_scale=0.125, max_scale=2.0,
+                    min_size=0, max_size=9999, top_k=10000,
+                    verbose=False):
+    """
+    与extract_multiscale取相同的尺度, 但先准备好所有尺度的图像, 由net.predict_pyramid在合并后的候选点上
+    只做一次跨尺度的非极大值抑制, 并只为最终保留的点采样描述子
+    """
+    H, W, three = img.shape
+    assert three == 3, "should be a batch with a single RGB image"
+    assert max_scale <= 2
+    s = max_scale  # current scale factor
+
+    levels = []
+    while s + 0.001 >= max(min_scale, min_size / max(H, W)):
+        if s - 0.001 <= min(max_scale, max_size / max(H, W)):
+            if verbose: print(f"extracting at scale x{s:.02f} = {img.shape[1]:4d}x{img.shape[0]:3d}")
+            levels.append(img)
+        s /= scale_f
+
+        # down-scale the image for next iteration
+        nh, nw = round(H * s), round(W * s)
+        img = cv.resize(img, dsize=(nw, nh), interpolation=cv.INTER_LINEAR)
+
+    # 各尺度的输入尺寸不同, 整个金字塔只切换一次cudnn.benchmark
+    old_bm = torch.backends.cudnn.benchmark
+    torch.backends.cudnn.benchmark = False
+    res = net.predict_pyramid(levels, top_k=top_k)
+    torch.backends.cudnn.benchmark = old_bm
+
+    idxs = res['scores'].argsort()[-top_k or None:]
+    predictions = {
+        "keypoints": res['keypoints'][idxs],
+        "descriptors": res['descriptors'][idxs],
+        "scores": res['scores'][idxs],
+        "shape": res['shape']
+    }
+
+    return predictions
+
 def extract_singlescale(net, img,top_k=10000 ,image_name=None):
     old_bm = torch.backends.cudnn.benchmark
     torch.backends.cudnn.benchmark = False
@@ -81,7 +126,7 @@ def extract_singlescale(net, img,top_k=10000 ,image_name=None):
     X, Y, S, C, Q, D = [], [], [], [], [], []
     with torch.no_grad():
        #res = net.predict(img=img,image_name=image_name)
-       res = net.predict(img=img)
+       res = net.predict(img=img, top_k=top_k)
     x = res['keypoints'][:,0]
     y = res['keypoints'][:,1]
     d = res['descriptors']
@@ -108,6 +153,47 @@ def extract_singlescale(net, img,top_k=10000 ,image_name=None):
 
     return predictions
 
+def save_predictions(predictions, output_root, tag, output_type, folder_name, image_name):
+    if output_type=='benchmark':
+        output_dir = Path(output_root,tag,folder_name)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        outpath = Path(output_dir, image_name)
+        np.savez(str(outpath), **predictions)
+    else:
+        output_dir = Path(output_root, folder_name)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        outpath = Path(output_dir, image_name + '.ppm.' + tag)
+        with open(outpath, 'wb') as f:
+            np.savez(f, **predictions)
+
+
+def _single_sample(batch):
+    return batch[0]
+
+
+def export_stream(dataset, extract, save, num_workers=4, num_writers=2, queue_size=8):
+    """
+    生产者/消费者模式导出: DataLoader的worker预取并解码图像, 主线程只做推理, 写线程池异步保存结果
+    Args:
+        extract: extract(image) -> predictions, 在主线程中调用
+        save: save(predictions, folder_name, image_name), 在写线程中调用
+        queue_size: 尚未写完的结果数上限, 超过时主线程等待最早提交的写任务
+    """
+    # 不打乱顺序, 预取队列长度由DataLoader按num_workers限定
+    loader = DataLoader(dataset, batch_size=1, shuffle=False, num_workers=num_workers,
+                        collate_fn=_single_sample)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(num_writers, 1)) as writer:
+        for data in tqdm(loader, total=len(dataset)):
+            predictions = extract(data['image'])
+            pending.append(writer.submit(save, predictions, data['folder_name'], data['image_name']))
+            # 按提交顺序等待, 同时让写线程中的异常在主线程抛出
+            while len(pending) > queue_size:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', type=str,default='../configs/MTLDesc_eva.yaml')
@@ -120,6 +206,13 @@ if __name__ == '__main__':
     parser.add_argument("--min-scale", type=float, default=0.3)
     parser.add_argument("--max-scale", type=float, default=1)
     parser.add_argument('--tag', type=str, default='mtldesc',required=True)
+    parser.add_argument('--pyramid', action='store_true', help='multi-scale with one cross-scale nms, used when not --single')
+    parser.add_argument('--stream', action='store_true', help='prefetch images and write results asynchronously')
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--num-writers', type=int, default=2)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--encoding', type=str, default='float32', choices=ENCODINGS)
+    parser.add_argument('--pca', type=str, default='', help='projection fitted by compact_descriptors.py fit')
     args = parser.parse_args()
 
     with open(args.config, 'r') as f:
@@ -131,29 +224,46 @@ if __name__ == '__main__':
 
     dataset = OrgHPatchDataset(**config['hpatches'])
  #   time_collect = []
+    pca = load_pca(args.pca) if args.encoding == 'pca' else None
+
+    if config['output_type'] == 'store':
+        # 所有特征追加写入<output_root>/<tag>.feats, 单个写线程保证文件布局确定
+        store = FeatureStoreWriter(Path(output_root, args.tag + '.feats'))
+        args.num_writers = 1
+
+        def save(predictions, folder_name, image_name):
+            predictions.update(encode_descriptors(predictions['descriptors'], args.encoding, pca))
+            store.append(folder_name, image_name, predictions)
+    else:
+        store = None
+
+        def save(predictions, folder_name, image_name):
+            predictions.update(encode_descriptors(predictions['descriptors'], args.encoding, pca))
+            save_predictions(predictions, output_root, args.tag, config['output_type'], folder_name, image_name)
+
     with get_model(config['model']['name'])(**config['model']) as net:
-        for i, data in tqdm(enumerate(dataset)):
-            image_name = data['image_name']
-            folder_name = data['folder_name']
+        def extract(image):
             if args.single==True:
-                start_time = time.time()
-                predictions = extract_singlescale(net, data['image'],top_k=args.top_k,image_name=folder_name+'_'+image_name)
-              #  time_collect.append(time.time() - start_time)
+                return extract_singlescale(net, image,top_k=args.top_k)
+            elif args.pyramid:
+                return extract_pyramid(net, image, scale_f=args.scale_f,
+                           min_scale=args.min_scale, max_scale=args.max_scale,
+                           min_size=args.min_size, max_size=args.max_size,top_k=args.top_k,verbose=True)
             else:
-                predictions = extract_multiscale(net, data['image'], scale_f=args.scale_f,
+                return extract_multiscale(net, image, scale_f=args.scale_f,
                            min_scale=args.min_scale, max_scale=args.max_scale,
                            min_size=args.min_size, max_size=args.max_size,top_k=args.top_k,verbose=True)
 
-            if config['output_type']=='benchmark':
-                output_dir = Path(output_root,args.tag,folder_name)
-                output_dir.mkdir(parents=True, exist_ok=True)
-                outpath = Path(output_dir, image_name)
-                np.savez(str(outpath), **predictions)
-            else:
-                output_dir = Path(output_root, folder_name)
-                output_dir.mkdir(parents=True, exist_ok=True)
-                outpath = Path(output_dir, image_name + '.ppm.' + args.tag)
-                np.savez(open(outpath, 'wb'), **predictions)
+        if args.stream:
+            export_stream(dataset, extract, save, num_workers=args.num_workers,
+                          num_writers=args.num_writers, queue_size=args.queue_size)
+        else:
+            for i, data in tqdm(enumerate(dataset)):
+                predictions = extract(data['image'])
+                save(predictions, data['folder_name'], data['image_name'])
+
+    if store is not None:
+        store.close()
      #   info = average_inference_time(time_collect)
       #  print(info)
 
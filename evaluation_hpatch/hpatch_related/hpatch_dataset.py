@@ -149,7 +149,7 @@ class OrgHPatchDataset(Dataset):
 
     def _format_file_list(self):
         data_list = []
-        folder_list = os.listdir(self.dataset_dir)
+        folder_list = sorted(os.listdir(self.dataset_dir))  # 保证导出顺序确定
         for folder in folder_list:
             images = glob.glob(os.path.join(self.dataset_dir, folder, "*.ppm"))
             images = sorted(images)
@@ -17,9 +17,21 @@ class Mtldesc(object):
             "nms_dist": 4,
             "dim": 128,
             "nms_radius": 4,
+            "nms_type": "vectorized",  # vectorized or fast
             "border_remove": 4,
+            "batch_size": 8,
+            "select_on_device": False,  # 在网络所在设备上完成阈值、NMS、去边界及top-k
+            "top_k": 0,  # 0表示不限制点数
+            "tile_size": 0,  # 大于0时对超过该尺寸的图像分块前向, 用于超大图像
+            "tile_halo": 128,  # 分块之间的重叠, 需覆盖dilation=18的描述子卷积的感受野
+            "sparse_descriptor": False,  # 只在特征点附近计算描述子的dilated卷积细化, 结果与稠密计算一致
+            "attention_backend": "eager",  # eager or sdpa
+            "context_layers": 12,  # 全局上下文transformer的层数, 与checkpoint一致
+            "context_mlp_dim": 2048,
         }
         self.config.update(config)
+        if self.config['sparse_descriptor'] and self.config['tile_size'] > 0:
+            assert False
 
         self.detection_threshold = self.config["detection_threshold"]
         self.nms_dist = self.config["nms_dist"]
@@ -34,7 +46,9 @@ class Mtldesc(object):
 
         # 初始化模型
         self.model_name = self.config['backbone'].split('.')[-1]
-        model = get_model(self.config['backbone'])()
+        model = get_model(self.config['backbone'])(attention_backend=self.config['attention_backend'],
+                                                   context_layers=self.config['context_layers'],
+                                                   context_mlp_dim=self.config['context_mlp_dim'])
         self.model = model.to(self.device)
         print("Initialize " +str(self.model_name))
 
@@ -64,7 +78,7 @@ class Mtldesc(object):
         self.model = self._load_model_params(model_ckpt, self.model)
 
 
-    def _generate_predict_point(self, heatmap, height, width):
+    def _generate_predict_point(self, heatmap, height, width, top_k=0):
         xs, ys = np.where(heatmap >= self.config['detection_threshold'])
         pts = np.zeros((3, len(xs)))  # Populate point data sized 3xN.
         if len(xs) > 0:
@@ -73,10 +87,11 @@ class Mtldesc(object):
             pts[2, :] = heatmap[xs, ys]
 
             if self.config['nms_radius']:
-                pts, _ = self.nms_fast(
-                    pts, height, width, dist_thresh=self.config['nms_radius'])
-            inds = np.argsort(pts[2, :])
-            pts = pts[:, inds[::-1]]  # Sort by confidence.
+                if self.config['nms_type'] == 'vectorized':
+                    nms = self.nms_vectorized
+                else:
+                    nms = self.nms_fast
+                pts, _ = nms(pts, height, width, dist_thresh=self.config['nms_radius'])
 
             # Remove points along border.
             bord = self.config['border_remove']
@@ -84,6 +99,13 @@ class Mtldesc(object):
             toremoveH = np.logical_or(pts[1, :] < bord, pts[1, :] >= (height-bord))
             toremove = np.logical_or(toremoveW, toremoveH)
             pts = pts[:, ~toremove]
+
+            # Keep the top_k most confident points, partial selection before sorting.
+            if top_k and pts.shape[1] > top_k:
+                inds = np.argpartition(-pts[2, :], top_k - 1)[:top_k]
+                pts = pts[:, inds]
+            inds = np.argsort(pts[2, :])
+            pts = pts[:, inds[::-1]]  # Sort by confidence.
             pts = pts.transpose()
 
         point = pts[:, :2][:, ::-1]
@@ -120,7 +142,8 @@ class Mtldesc(object):
         grid = np.zeros((H, W)).astype(int) # Track NMS data.
         inds = np.zeros((H, W)).astype(int) # Store indices of points.
         # Sort by confidence and round to nearest int.
-        inds1 = np.argsort(-in_corners[2,:])
+        # 稳定排序, 置信度相同的点保持输入(行优先)的顺序, 与nms_torch一致
+        inds1 = np.argsort(-in_corners[2,:], kind='mergesort')
         corners = in_corners[:,inds1]
         rcorners = corners[:2,:].round().astype(int) # Rounded corners.
         # Check for edge case of 0 or 1 corners.
@@ -157,19 +180,171 @@ class Mtldesc(object):
 
         return out, out_inds
 
-    def predict(self, img, keys="*"):
+    def nms_vectorized(self, in_corners, H, W, dist_thresh):
         """
-        获取一幅灰度图像对应的特征点及其描述子
+        与nms_fast结果一致的向量化非极大值抑制，不分配HxW的网格，也没有逐点的Python循环。
+
+        Algo summary: 按置信度降序排序后，将取整坐标编码为整数，用searchsorted查找每个点
+        (2r+1)x(2r+1)窗口内的邻居，得到"高置信度点->低置信度点"的有向边。之后并行迭代：
+        没有待处理的更高置信度邻居的点必然被贪心算法保留，将其保留并抑制其邻域内的待处理点，
+        直到所有点处理完毕。每一轮至少确定置信度最高的待处理点，结果与逐点贪心的nms_fast相同。
+
+        NOTE: 与nms_fast一样假设取整后的点位置互不相同，由热图阈值化得到的点总是满足这一条件。
+
+        Inputs/Returns 同 nms_fast
+        """
+        # Sort by confidence and round to nearest int.
+        # 稳定排序, 置信度相同的点保持输入(行优先)的顺序, 与nms_torch一致
+        inds1 = np.argsort(-in_corners[2,:], kind='mergesort')
+        corners = in_corners[:,inds1]
+        rcorners = corners[:2,:].round().astype(int)
+        # Check for edge case of 0 or 1 corners.
+        if rcorners.shape[1] == 0:
+            return np.zeros((3,0)).astype(int), np.zeros(0).astype(int)
+        if rcorners.shape[1] == 1:
+            out = np.vstack((rcorners, in_corners[2])).reshape(3,1)
+            return out, np.zeros((1)).astype(int)
+
+        num = rcorners.shape[1]
+        pad = dist_thresh
+        # 在左右各pad的位置编码，保证窗口偏移不会跨行
+        stride = W + 2 * pad
+        keys = (rcorners[1].astype(np.int64) + pad) * stride + (rcorners[0] + pad)
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+
+        # 邻居关系是对称的，只需查找下方各行及同一行右侧的邻居。
+        # 编码按行优先有序，同一行窗口内的邻居在排序数组中是连续的，每行只需一次searchsorted
+        dom_list, sub_list = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+        for dy in range(0, pad + 1):
+            if dy == 0:
+                first = np.arange(1, num + 1)
+                span = pad
+            else:
+                first = np.searchsorted(sorted_keys, sorted_keys + (dy * stride - pad))
+                span = 2 * pad + 1
+            upper = sorted_keys + (dy * stride + pad)
+            for j in range(span):
+                pos = np.minimum(first + j, num - 1)
+                hit = np.nonzero((first + j < num) & (sorted_keys[pos] <= upper))[0]
+                src = order[hit]
+                dst = order[pos[hit]]
+                # 排序后的下标即置信度排名，较小者为支配点
+                dom_list.append(np.minimum(src, dst))
+                sub_list.append(np.maximum(src, dst))
+        dom = np.concatenate(dom_list)
+        sub = np.concatenate(sub_list)
+
+        keep = np.zeros(num, dtype=bool)
+        pending = np.ones(num, dtype=bool)
+        while pending.any():
+            blocked = np.zeros(num, dtype=bool)
+            blocked[sub] = True
+            kept_now = pending & ~blocked
+            keep |= kept_now
+            pending &= ~kept_now
+            pending[sub[kept_now[dom]]] = False
+            # 只保留两端都待处理的边
+            live = pending[dom] & pending[sub]
+            dom, sub = dom[live], sub[live]
+
+        # 保留点已按置信度降序排列
+        inds_keep = np.nonzero(keep)[0]
+        out = corners[:, inds_keep]
+        out_inds = inds1[inds_keep]
+
+        return out, out_inds
+
+    def _generate_predict_point_torch(self, prob, height, width, top_k=0):
+        """
+        _generate_predict_point的torch版本，概率图始终留在网络所在设备上，只返回最终保留的点
         Args:
-            img: [h,w] 灰度图像,要求h,w能被16整除
+            prob: [h,w] 概率图tensor
+            top_k: 保留置信度最高的top_k个点, 0表示全部保留
         Returns:
-            point: [n,2] 特征点,输出点以y,x为顺序
-            descriptor: [n,128] 描述子
+            point: [n,2] 顺序是y,x, 按置信度降序
+            score: [n]
         """
-        # switch to eval mode
-        self.model.eval()
-      #  self.extractor.eval()
+        candidate = prob >= self.config['detection_threshold']
+
+        radius = self.config['nms_radius']
+        if radius:
+            keep = self.nms_torch(prob, candidate, radius)
+        else:
+            keep = candidate
+
+        # Remove points along border.
+        bord = self.config['border_remove']
+        if bord > 0:
+            keep[:bord, :] = False
+            keep[height-bord:, :] = False
+            keep[:, :bord] = False
+            keep[:, width-bord:] = False
+
+        idx = torch.nonzero(keep)
+        ys, xs = idx[:, 0], idx[:, 1]
+        score = prob[ys, xs]
+
+        if top_k and score.shape[0] > top_k:
+            score, inds = torch.topk(score, top_k)
+        else:
+            score, inds = torch.sort(score, descending=True)
+        point = torch.stack((ys[inds], xs[inds]), dim=1).to(torch.float)
 
+        return point, score
+
+    @staticmethod
+    def nms_torch(prob, candidate, dist_thresh):
+        """
+        基于max-pooling的贪心非极大值抑制，保留的点与nms_fast相同
+        候选点按(置信度降序, 行优先位置升序)排名，与nms_fast的稳定排序一致，置信度相同(如sigmoid饱和为1)时结果也相同
+        每一轮中窗口内置信度排名最高的待处理点被保留，并抑制其(2r+1)x(2r+1)窗口内的待处理点
+        Args:
+            prob: [h,w] 概率图
+            candidate: [h,w] bool, 参与NMS的点
+            dist_thresh: 抑制半径, infinity norm
+        Returns:
+            keep: [h,w] bool, 保留的点
+        """
+        kernel_size = 2 * dist_thresh + 1
+        # 将置信度转换为互不相同的排名，保证每个窗口内的最大值唯一
+        flat_idx = torch.nonzero(candidate.view(-1))[:, 0]
+        num = flat_idx.shape[0]
+        if num == 0:
+            return candidate.clone()
+        # torch.sort不保证稳定, 将(置信度降序, 位置升序)编码为互不相同的整数后排序
+        _, level = torch.unique(prob.view(-1)[flat_idx], sorted=True, return_inverse=True)
+        key = (level.max() - level) * num + torch.arange(num, device=level.device)
+        _, order = torch.sort(key)
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(order.shape[0], device=order.device)
+        priority = torch.full_like(prob, -float('inf')).view(-1)
+        priority[flat_idx] = -rank.to(prob.dtype)
+        priority = priority.view(1, 1, *prob.shape)
+
+        pending = candidate.clone().view(1, 1, *prob.shape)
+        keep = torch.zeros_like(pending)
+        while pending.any():
+            masked = torch.where(pending, priority, torch.full_like(priority, -float('inf')))
+            pooled = f.max_pool2d(masked, kernel_size=kernel_size, stride=1, padding=dist_thresh)
+            kept_now = pending & (masked == pooled)
+            keep |= kept_now
+            suppressed = f.max_pool2d(kept_now.to(prob.dtype), kernel_size=kernel_size, stride=1,
+                                      padding=dist_thresh) > 0
+            pending &= ~suppressed
+
+        return keep[0, 0]
+
+    def _preprocess(self, img):
+        """
+        将图像缩放到16的整数倍并转换为网络输入
+        Args:
+            img: [h,w,3] rgb图像
+        Returns:
+            img: [1,3,h',w'] 归一化到[-1,1]的输入
+            scale_h, scale_w: 缩放后的尺寸
+            sh, sw: 由缩放后尺寸恢复到原始尺寸的比例
+        """
         shape = img.shape
         assert shape[2] == 3  # must be rgb
 
@@ -196,22 +371,29 @@ class Mtldesc(object):
         img = torch.from_numpy(img).to(torch.float).unsqueeze(dim=0).permute((0, 3, 1, 2)).to(self.device)
         img = (img / 255.) * 2. - 1.
 
-        # detector
-        heatmap, feature,weightmap = self.model(img)
-        #heatmap2=f.interpolate(weightmap,  heatmap.shape[2:], mode='bilinear')
-        prob = torch.sigmoid(heatmap)
-        #prob2 = torch.sigmoid(heatmap2)
-        #prob=(prob+prob2)/2
-        # 得到对应的预测点
-        prob = prob.detach().cpu().numpy()
-        prob = prob[0, 0]
+        return img, scale_h, scale_w, sh, sw
+
+    def _postprocess(self, prob, feature, weightmap, shape, scale_h, scale_w, sh, sw, keys="*", top_k=0):
+        """
+        由单幅图像的概率图及特征图得到特征点、描述子及得分
+        Args:
+            prob: [h,w] numpy概率图, 或留在设备上的概率图tensor(select_on_device)
+            feature, weightmap: batchsize为1的描述子特征图及权重图
+            top_k: 在采样描述子之前保留置信度最高的top_k个点, 0表示全部保留
+        """
+        if isinstance(prob, np.ndarray):
+            point, score = self._generate_predict_point(prob, height=scale_h, width=scale_w, top_k=top_k)  # [n,2]
+        else:
+            point, score = self._generate_predict_point_torch(prob, height=scale_h, width=scale_w, top_k=top_k)
 
-        point, score = self._generate_predict_point(prob, height=scale_h, width=scale_w)  # [n,2]
-        #weightmap=heatmap
         # descriptor
-        desp = self._generate_combined_descriptor_fast(point, feature,weightmap, scale_h, scale_w)
-        #print(weightmap)
-        #exit(0)
+        desp = self._generate_combined_descriptor_fast(point, feature, weightmap, scale_h, scale_w)
+
+        if torch.is_tensor(point):
+            # 只有最终保留的点被拷贝回cpu
+            point = point.cpu().numpy()
+            score = score.cpu().numpy()
+
         # scale point back to the original scale and change to x-y
         point = (point * np.array((sh, sw)))[:, ::-1]
 
@@ -227,6 +409,172 @@ class Mtldesc(object):
 
         return predictions
 
+    def _forward(self, img):
+        if self.config['tile_size'] > 0:
+            with torch.no_grad():
+                return self.model.forward_tiled(img, tile_size=self.config['tile_size'],
+                                                halo=self.config['tile_halo'])
+        if self.config['sparse_descriptor']:
+            return self.model(img, refine=False)
+        return self.model(img)
+
+    def predict(self, img, keys="*", top_k=None):
+        """
+        获取一幅灰度图像对应的特征点及其描述子
+        Args:
+            img: [h,w] 灰度图像,要求h,w能被16整除
+            top_k: 只为置信度最高的top_k个点计算描述子, None时使用config中的top_k, 0表示全部保留
+        Returns:
+            point: [n,2] 特征点,输出点以y,x为顺序
+            descriptor: [n,128] 描述子
+        """
+        # switch to eval mode
+        self.model.eval()
+      #  self.extractor.eval()
+
+        shape = img.shape
+        img, scale_h, scale_w, sh, sw = self._preprocess(img)
+
+        # detector
+        heatmap, feature,weightmap = self._forward(img)
+        #heatmap2=f.interpolate(weightmap,  heatmap.shape[2:], mode='bilinear')
+        prob = torch.sigmoid(heatmap)
+        #prob2 = torch.sigmoid(heatmap2)
+        #prob=(prob+prob2)/2
+        # 得到对应的预测点, 在no_grad之外调用时概率图带有梯度, 在设备上选点前同样需要detach
+        prob = prob.detach()
+        if not self.config['select_on_device']:
+            prob = prob.cpu().numpy()
+        prob = prob[0, 0]
+
+        if top_k is None:
+            top_k = self.config['top_k']
+
+        return self._postprocess(prob, feature, weightmap, shape, scale_h, scale_w, sh, sw, keys=keys, top_k=top_k)
+
+    def predict_batch(self, images, keys="*", top_k=None):
+        """
+        批量获取多幅图像的特征点及其描述子，缩放到16整数倍后尺寸相同的图像合并为一个batch进行前向，
+        每个batch的概率图只拷贝回cpu一次(select_on_device时不拷贝)。不同尺寸的图像不做padding，因为padding会改变全局上下文分支的池化结果
+        Args:
+            images: list of [h,w,3] rgb图像
+            top_k: 同predict
+        Returns:
+            predictions: list, 与images顺序一致, 每一项与predict的输出相同
+        """
+        self.model.eval()
+        if top_k is None:
+            top_k = self.config['top_k']
+
+        # 按缩放后的尺寸分组
+        groups = {}
+        for idx, img in enumerate(images):
+            shape = img.shape
+            tensor, scale_h, scale_w, sh, sw = self._preprocess(img)
+            groups.setdefault((scale_h, scale_w), []).append((idx, shape, tensor, sh, sw))
+
+        batch_size = max(int(self.config['batch_size']), 1)
+        predictions = [None] * len(images)
+        for (scale_h, scale_w), group in groups.items():
+            for start in range(0, len(group), batch_size):
+                chunk = group[start:start + batch_size]
+                batch = torch.cat([item[2] for item in chunk], dim=0)
+
+                with torch.no_grad():
+                    heatmap, feature, weightmap = self._forward(batch)
+                    prob = torch.sigmoid(heatmap)  # [b,1,h,w]
+                    if not self.config['select_on_device']:
+                        prob = prob.detach().cpu().numpy()
+
+                    for j, (idx, shape, _, sh, sw) in enumerate(chunk):
+                        predictions[idx] = self._postprocess(
+                            prob[j, 0], feature[j:j+1], weightmap[j:j+1], shape, scale_h, scale_w, sh, sw, keys=keys,
+                            top_k=top_k)
+
+        return predictions
+
+    def predict_pyramid(self, images, top_k=None):
+        """
+        多尺度提取特征点及描述子。各尺度前向后只把阈值化的候选点拷贝回cpu, 所有尺度的候选点换算到原图坐标后
+        合并做一次非极大值抑制(半径nms_radius, 原图像素), 同一位置在不同尺度上的重复点只保留置信度最高的一个,
+        最后只为保留下来的点在其所在尺度的特征图上采样描述子
+        Args:
+            images: list of [h,w,3] rgb图像, 同一幅图像的各个尺度, images[0]为原始尺度
+            top_k: 同predict
+        Returns:
+            predictions: 与predict相同, keypoints为images[0]上的x,y坐标, 按置信度降序
+        """
+        self.model.eval()
+        if top_k is None:
+            top_k = self.config['top_k']
+
+        shape = images[0].shape
+        org_h, org_w = shape[0], shape[1]
+        levels = []
+        level_points, points, scores, level_ids = [], [], [], []
+        with torch.no_grad():
+            for level_idx, img in enumerate(images):
+                tensor, scale_h, scale_w, sh, sw = self._preprocess(img)
+                heatmap, feature, weightmap = self._forward(tensor)
+                prob = torch.sigmoid(heatmap)[0, 0]
+                point = torch.nonzero(prob >= self.config['detection_threshold'])  # [n,2] y,x
+                score = prob[point[:, 0], point[:, 1]]
+                levels.append((feature, weightmap, scale_h, scale_w))
+
+                point = point.cpu().numpy()
+                level_points.append(point)
+                points.append(point * np.array((sh * org_h / img.shape[0], sw * org_w / img.shape[1])))
+                scores.append(score.cpu().numpy())
+                level_ids.append(np.full(point.shape[0], level_idx))
+
+        level_points = np.concatenate(level_points, axis=0)
+        points = np.concatenate(points, axis=0)
+        scores = np.concatenate(scores, axis=0)
+        level_ids = np.concatenate(level_ids, axis=0)
+
+        # 同一取整位置上的多个候选点必然互相抑制, 先只保留置信度最高的一个, nms_vectorized要求位置互不相同
+        rpoints = points.round().astype(np.int64)
+        keys = rpoints[:, 0] * (org_w + 2 * self.config['nms_radius'] + 2) + rpoints[:, 1]
+        order = np.lexsort((-scores, keys))
+        first = np.ones(order.shape[0], dtype=bool)
+        first[1:] = keys[order[1:]] != keys[order[:-1]]
+        inds = order[first]
+
+        if self.config['nms_radius'] and inds.shape[0] > 0:
+            corners = np.stack((points[inds, 1], points[inds, 0], scores[inds]), axis=0)
+            _, keep = self.nms_vectorized(corners, org_h, org_w, dist_thresh=self.config['nms_radius'])
+            inds = inds[keep]
+
+        # Remove points along border of their own level.
+        bord = self.config['border_remove']
+        level_h = np.array([level[2] for level in levels])[level_ids[inds]]
+        level_w = np.array([level[3] for level in levels])[level_ids[inds]]
+        point = level_points[inds]
+        toremove = (point[:, 0] < bord) | (point[:, 0] >= level_h - bord) | \
+                   (point[:, 1] < bord) | (point[:, 1] >= level_w - bord)
+        inds = inds[~toremove]
+
+        if top_k and inds.shape[0] > top_k:
+            inds = inds[np.argpartition(-scores[inds], top_k - 1)[:top_k]]
+        inds = inds[np.argsort(-scores[inds], kind='stable')]
+
+        # descriptor, 每个尺度只采样保留下来的点
+        desp = np.zeros((inds.shape[0], self.config['dim']), dtype=np.float32)
+        with torch.no_grad():
+            for level_idx, (feature, weightmap, scale_h, scale_w) in enumerate(levels):
+                sel = np.nonzero(level_ids[inds] == level_idx)[0]
+                if sel.shape[0] > 0:
+                    desp[sel] = self._generate_combined_descriptor_fast(
+                        level_points[inds[sel]].astype(np.float64), feature, weightmap, scale_h, scale_w)
+
+        predictions = {
+            "shape": shape,
+            "keypoints": points[inds][:, ::-1],
+            "descriptors": desp,
+            "scores": scores[inds],
+        }
+        return predictions
+
     def generate_descriptor(self, input_image, point, image_shape):
         """
         给定点，获取描述子
@@ -275,15 +623,22 @@ class Mtldesc(object):
         """
         用多层级的组合特征构造描述子
         Args:
-            point: [n,2] 顺序是y,x
+            point: [n,2] 顺序是y,x, numpy数组或已在设备上的tensor
             c1,c2,c3,c4: 分别对应resnet4个block输出的特征,batchsize都是1
         Returns:
             desp: [n,dim]
         """
-        point = torch.from_numpy(point[:, ::-1].copy()).to(torch.float).to(self.device)
+        if isinstance(point, np.ndarray):
+            point = torch.from_numpy(point[:, ::-1].copy()).to(torch.float).to(self.device)
+        else:
+            point = point.flip(1)
         # 归一化采样坐标到[-1,1]
         point = point * 2. / torch.tensor((width-1, height-1), dtype=torch.float, device=self.device) - 1
         point = point.unsqueeze(dim=0).unsqueeze(dim=2)  # [1,n,1,2]
+        if self.config['sparse_descriptor']:
+            # feature是细化前的描述子, 只在采样会用到的像素上细化
+            with torch.no_grad():
+                feature = self.model.refine_descriptor_sparse(feature, point)
 
         feature_pair = f.grid_sample(feature, point, mode="bilinear")[:, :, :, 0].transpose(1, 2)[0]
         weight_pair = f.grid_sample(weight_map, point, mode="bilinear", padding_mode="border")[:, :, :, 0].transpose(1, 2)[0]#.squeeze(dim=1)
@@ -306,3 +661,34 @@ class Mtldesc(object):
         pass
 
 
+
+
+def _check_nms_ties(trials=100, height=48, width=64, radius=4, seed=0):
+    """
+    在置信度大量相同的随机概率图上检查nms_vectorized、nms_torch与nms_fast保留的点集合完全相同
+    """
+    rng = np.random.RandomState(seed)
+    nms = Mtldesc.__new__(Mtldesc)  # 只用到NMS, 不加载网络
+    for trial in range(trials):
+        # 量化置信度, 模拟float32 sigmoid饱和为1.0时的大量并列
+        heatmap = np.round(rng.rand(height, width) * rng.randint(1, 5), 0) / 4.
+        heatmap = heatmap.astype(np.float32)
+        xs, ys = np.where(heatmap >= 0.25)
+        pts = np.stack((ys, xs, heatmap[xs, ys])).astype(np.float64)
+        out, _ = nms.nms_fast(pts, height, width, dist_thresh=radius)
+        expected = set(zip(out[1].astype(int).tolist(), out[0].astype(int).tolist()))
+
+        out, _ = nms.nms_vectorized(pts, height, width, dist_thresh=radius)
+        result = set(zip(out[1].astype(int).tolist(), out[0].astype(int).tolist()))
+        assert result == expected, 'nms_vectorized differs from nms_fast in trial %d' % trial
+
+        prob = torch.from_numpy(heatmap)
+        keep = Mtldesc.nms_torch(prob, prob >= 0.25, radius)
+        result = set(map(tuple, torch.nonzero(keep).tolist()))
+        assert result == expected, 'nms_torch differs from nms_fast in trial %d' % trial
+    print('nms_vectorized and nms_torch match nms_fast on %d tie-heavy grids' % trials)
+
+
+if __name__ == '__main__':
+    # 自检: python models/MTLDesc.py
+    _check_nms_ties()
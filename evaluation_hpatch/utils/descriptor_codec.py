@@ -0,0 +1,86 @@
+#
+# Created  on 2021/3/4
+#
+import numpy as np
+
+ENCODINGS = ['float32', 'fp16', 'int8', 'pca']
+
+
+def encode_descriptors(descriptors, encoding='float32', pca=None):
+    """
+    将描述子编码为更紧凑的存储格式
+    Args:
+        descriptors: [n,dim] float32描述子
+        encoding: float32, fp16, int8(每个描述子单独缩放) 或 pca(投影到pca['components']的低维空间)
+        pca: load_pca/fit_pca得到的投影, 仅pca编码需要
+    Returns:
+        dict, 直接合并进导出的predictions
+    """
+    descriptors = np.asarray(descriptors, dtype=np.float32)
+    if encoding == 'float32':
+        return {'descriptors': descriptors}
+    elif encoding == 'fp16':
+        code = descriptors.astype(np.float16)
+        return {'descriptors': code, 'descriptor_encoding': np.array(encoding)}
+    elif encoding == 'int8':
+        scale = np.max(np.abs(descriptors), axis=1) / 127.
+        scale[scale == 0] = 1.
+        code = np.round(descriptors / scale[:, np.newaxis]).astype(np.int8)
+        return {'descriptors': code, 'descriptor_scale': scale.astype(np.float32),
+                'descriptor_encoding': np.array(encoding)}
+    elif encoding == 'pca':
+        assert pca is not None
+        code = np.matmul(descriptors - pca['mean'], pca['components'].T).astype(np.float32)
+        return {'descriptors': code, 'descriptor_encoding': np.array(encoding)}
+    else:
+        assert False
+
+
+def decode_descriptors(feats, pca=None):
+    """
+    encode_descriptors的逆过程, 返回[n,dim] float32描述子; 没有编码信息的特征原样返回
+    """
+    if 'descriptor_encoding' not in feats:
+        return feats['descriptors']
+
+    encoding = str(feats['descriptor_encoding'])
+    code = feats['descriptors']
+    if encoding == 'fp16':
+        return code.astype(np.float32)
+    elif encoding == 'int8':
+        return code.astype(np.float32) * feats['descriptor_scale'][:, np.newaxis]
+    elif encoding == 'pca':
+        assert pca is not None
+        # 重建回原始维度, 匹配时内积近似于原始描述子的内积
+        return (np.matmul(code, pca['components']) + pca['mean']).astype(np.float32)
+    else:
+        assert False
+
+
+def encoded_bytes(encoded):
+    return sum(value.nbytes for key, value in encoded.items() if key != 'descriptor_encoding')
+
+
+def fit_pca(descriptors, dim):
+    """
+    由导出描述子的采样拟合PCA投影
+    Args:
+        descriptors: [n,128] 采样的描述子
+        dim: 投影后的维度
+    Returns:
+        pca: {'mean': [128], 'components': [dim,128]}
+    """
+    descriptors = np.asarray(descriptors, dtype=np.float64)
+    mean = np.mean(descriptors, axis=0)
+    _, _, vt = np.linalg.svd(descriptors - mean, full_matrices=False)
+    return {'mean': mean.astype(np.float32), 'components': vt[:dim].astype(np.float32)}
+
+
+def save_pca(path, pca):
+    with open(path, 'wb') as f:
+        np.savez(f, **pca)
+
+
+def load_pca(path):
+    aux = np.load(path)
+    return {'mean': aux['mean'], 'components': aux['components']}
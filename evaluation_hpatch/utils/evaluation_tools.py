@@ -3,6 +3,7 @@
 #
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
 
 
 class MovingAverage(object):
@@ -255,92 +256,45 @@ class RepeatabilityCalculator(object):
         project_point_0 = np.matmul(homography, homo_point_0)
         project_point_0 = project_point_0[:, :2, 0] / project_point_0[:, 2:3, 0]
         project_point_0, inlier_point_0 = self._exclude_outlier(project_point_0, point_0, height=shape_1[0], width=shape_1[1])
-        if project_point_0.size > 0:
-            correctness_0_1, repeat_0 = self.compute_correctness(project_point_0, point_1)
-        else:
-            correctness_0_1 = 0
-            repeat_0 = None
-
-        repeat_list_0 = []
-        nonrepeat_list_0 = []
-        if repeat_0 is not None:
-            for i in range(repeat_0.size):
-                if repeat_0[i]:
-                    repeat_list_0.append(inlier_point_0[i])
-                else:
-                    nonrepeat_list_0.append(inlier_point_0[i])
-            if len(repeat_list_0) > 0:
-                repeat_0 = np.stack(repeat_list_0, axis=0)[:, ::-1]  # y,x顺序
-            else:
-                repeat_0 = np.empty((0, 2))
-            if len(nonrepeat_list_0) > 0:
-                nonrepeat_0 = np.stack(nonrepeat_list_0, axis=0)[:, ::-1]
-            else:
-                nonrepeat_0 = np.empty((0, 2))
-        else:
-            repeat_0 = np.empty((0, 2))
-            nonrepeat_0 = np.empty((0, 2))
+        correctness_0_1, repeat_0, nonrepeat_0 = self._split_repeat(project_point_0, inlier_point_0, point_1)
 
         # compute correctness from 1 to 0
         project_point_1 = np.matmul(inv_homography, homo_point_1)
         project_point_1 = project_point_1[:, :2, 0] / project_point_1[:, 2:3, 0]
         project_point_1, inlier_point_1 = self._exclude_outlier(project_point_1, point_1, height=shape_0[0], width=shape_0[1])
-        if project_point_1.size > 0:
-            correctness_1_0, repeat_1 = self.compute_correctness(project_point_1, point_0)
-        else:
-            correctness_1_0 = 0
-            repeat_1 = None
-
-        repeat_list_1 = []
-        nonrepeat_list_1 = []
-        if repeat_1 is not None:
-            for i in range(repeat_1.size):
-                if repeat_1[i]:
-                    repeat_list_1.append(inlier_point_1[i])
-                else:
-                    nonrepeat_list_1.append(inlier_point_1[i])
-            if len(repeat_list_1) > 0:
-                repeat_1 = np.stack(repeat_list_1, axis=0)[:, ::-1]  # y,x顺序
-            else:
-                repeat_1 = np.empty((0, 2))
-            if len(nonrepeat_list_1) > 0:
-                nonrepeat_1 = np.stack(nonrepeat_list_1, axis=0)[:, ::-1]
-            else:
-                nonrepeat_1 = np.empty((0, 2))
-        else:
-            repeat_1 = np.empty((0, 2))
-            nonrepeat_1 = np.empty((0, 2))
+        correctness_1_0, repeat_1, nonrepeat_1 = self._split_repeat(project_point_1, inlier_point_1, point_0)
 
         # compute repeatability
         total_point = np.shape(project_point_0)[0] + np.shape(project_point_1)[0]
         repeatability = (correctness_0_1 + correctness_1_0) / (total_point + 1e-3)
         return repeatability, repeat_0, nonrepeat_0, repeat_1, nonrepeat_1
 
+    def _split_repeat(self, project_point, inlier_point, point):
+        """
+        按投影点是否在另一幅图像中有epsilon范围内的点, 将inlier_point分为重复点与非重复点, 均为y,x顺序
+        """
+        if project_point.size == 0:
+            return 0, np.empty((0, 2)), np.empty((0, 2))
+        correctness, repeat = self.compute_correctness(project_point, point)
+        return correctness, inlier_point[repeat][:, ::-1], inlier_point[~repeat][:, ::-1]
+
     @staticmethod
     def _exclude_outlier(point, org_point, height, width):
-        inlier = []
-        org_inlier = []
-        for i in range(point.shape[0]):
-            x, y = point[i]
-            if x < 0 or x > width - 1:
-                continue
-            if y < 0 or y > height - 1:
-                continue
-            inlier.append(point[i])
-            org_inlier.append(org_point[i])
-        if len(inlier) > 0:
-            return np.stack(inlier, axis=0), np.stack(org_inlier, axis=0)
-        else:
+        x, y = point[:, 0], point[:, 1]
+        outlier = (x < 0) | (x > width - 1) | (y < 0) | (y > height - 1)
+        if np.all(outlier):
             return np.empty((0, 2)), np.empty((0, 2))
+        return point[~outlier], org_point[~outlier]
 
     def compute_correctness(self, point_0, point_1):
-        # compute the distance of two set of point
+        # 用KD树查询point_0中每个点在point_1中的最近邻距离, 内存为O(n+m)
         # point_0: [n, 2], point_1: [m,2]
-        point_0 = np.expand_dims(point_0, axis=1)  # [n, 1, 2]
-        point_1 = np.expand_dims(point_1, axis=0)  # [1, m, 2]
-        dist = np.linalg.norm(point_0 - point_1, axis=2)  # [n, m]
-
-        min_dist = np.min(dist, axis=1, keepdims=False)  # [n]
+        if np.shape(point_1)[0] == 0:
+            repeat = np.zeros((np.shape(point_0)[0],), dtype=bool)
+            return 0., repeat
+        tree = cKDTree(point_1)
+        # distance_upper_bound为开区间, 稍微放大后再按<=epsilon判断, 与原先的稠密距离矩阵结果一致
+        min_dist, _ = tree.query(point_0, k=1, distance_upper_bound=self.epsilon * (1 + 1e-6) + 1e-6)  # [n]
         repeat = np.less_equal(min_dist, self.epsilon)
         correctness = np.sum(repeat.astype(np.float))
 
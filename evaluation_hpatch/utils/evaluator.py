@@ -1,15 +1,26 @@
 import os
+import time
+import multiprocessing as mp
 
 import numpy as np
 import cv2
 import torch
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 
+from utils.feature_store import FeatureStoreReader
+from utils.descriptor_codec import decode_descriptors
+from utils.utils import mnn_matcher_chunked
+
 
 class Evaluator(object):
 
     def __init__(self):
         self.mutual_check = True
+        # 分块匹配的块大小, 是否用fp16计算相似度, ratio test阈值(None为不做)
+        self.match_chunk_size = 4096
+        self.match_fp16 = False
+        self.ratio_thld = None
         self.err_thld = np.arange(1, 16)  # range [1,15]
         if torch.cuda.is_available():
             self.device = torch.device('cuda:0')
@@ -21,6 +32,17 @@ class Evaluator(object):
             'all_eval_stats': np.zeros((len(self.err_thld), 8), np.float32),
         }
 
+    def settings(self):
+        """
+        影响评测结果的设置, 用作结果缓存key的一部分
+        """
+        return {
+            'err_thld': [int(thr) for thr in self.err_thld],
+            'mutual_check': self.mutual_check,
+            'match_fp16': self.match_fp16,
+            'ratio_thld': self.ratio_thld,
+        }
+
     def homo_trans(self, coord, H):
         kpt_num = coord.shape[0]
         homo_coord = np.concatenate((coord, np.ones((kpt_num, 1))), axis=-1)
@@ -30,20 +52,22 @@ class Evaluator(object):
         return proj_coord
 
     def mnn_matcher(self, descriptors_a, descriptors_b):
-        descriptors_a = torch.from_numpy(descriptors_a).to(self.device).to(torch.float)
-        descriptors_b = torch.from_numpy(descriptors_b).to(self.device).to(torch.float)
-        sim = descriptors_a @ descriptors_b.t()
-        nn12 = torch.max(sim, dim=1)[1]
-        nn21 = torch.max(sim, dim=0)[1]
-        ids1 = torch.arange(0, sim.shape[0], device=self.device)
-        mask = (ids1 == nn21[nn12])
-        matches = torch.stack([ids1[mask], nn12[mask]])
-        return matches.t().detach().cpu().numpy()
+        descriptors_a = torch.tensor(descriptors_a, dtype=torch.float, device=self.device)
+        descriptors_b = torch.tensor(descriptors_b, dtype=torch.float, device=self.device)
+        return mnn_matcher_chunked(descriptors_a, descriptors_b, chunk_size=self.match_chunk_size,
+                                   fp16=self.match_fp16, ratio=self.ratio_thld)
 
     def feature_matcher(self, ref_feat, test_feat):
-        matches = self.mnn_matcher(ref_feat, test_feat)
-        matches = [cv2.DMatch(matches[i][0], matches[i][1], 0) for i in range(matches.shape[0])]
-        return matches
+        """
+        Returns:
+            matches: [k,2] 整数下标数组, 每行为(queryIdx, trainIdx)
+        """
+        return self.mnn_matcher(ref_feat, test_feat)
+
+    @staticmethod
+    def to_dmatch(matches):
+        # 需要cv2.DMatch列表(如cv2.drawMatches)时再转换
+        return [cv2.DMatch(int(matches[i][0]), int(matches[i][1]), 0) for i in range(matches.shape[0])]
 
     def get_covisible_mask(self, ref_coord, test_coord, ref_img_shape, test_img_shape, gt_homo, scaling=1.):
         ref_coord = ref_coord / scaling
@@ -67,39 +91,46 @@ class Evaluator(object):
         return ref_mask, test_mask
 
     def get_inlier_matches(self, ref_coord, test_coord, putative_matches, gt_homo, scaling=1.):
-        p_ref_coord = np.float32([ref_coord[m.queryIdx] for m in putative_matches]) / scaling
-        p_test_coord = np.float32([test_coord[m.trainIdx] for m in putative_matches]) / scaling
+        """
+        Args:
+            putative_matches: [k,2] feature_matcher返回的下标数组
+        Returns:
+            inlier_matches_list: 每个阈值下的内点匹配, 均为[k',2]下标数组
+        """
+        p_ref_coord = ref_coord[putative_matches[:, 0]].astype(np.float32) / scaling
+        p_test_coord = test_coord[putative_matches[:, 1]].astype(np.float32) / scaling
 
         proj_p_ref_coord = self.homo_trans(p_ref_coord, gt_homo)
         dist = np.sqrt(np.sum(np.square(proj_p_ref_coord - p_test_coord[:, 0:2]), axis=-1))
         inlier_matches_list = []
         for err_thld in self.err_thld:
             inlier_mask = dist <= err_thld
-            inlier_matches = [putative_matches[z] for z in np.nonzero(inlier_mask)[0]]
-            inlier_matches_list.append(inlier_matches)
+            inlier_matches_list.append(putative_matches[inlier_mask])
         return inlier_matches_list
 
     def get_gt_matches(self, ref_coord, test_coord, gt_homo, scaling=1.):
+        """
+        用KD树求两组点互相的最近邻距离, 不再构造[N,M,2]的差值矩阵;
+        距离排序后用searchsorted一次得到所有阈值下的计数
+        """
         ref_coord = ref_coord / scaling
         test_coord = test_coord / scaling
+        if ref_coord.shape[0] == 0 or test_coord.shape[0] == 0:
+            return [0. for _ in self.err_thld]
         proj_ref_coord = self.homo_trans(ref_coord, gt_homo)
 
-        pt0 = np.expand_dims(proj_ref_coord, axis=1)
-        pt1 = np.expand_dims(test_coord, axis=0)
-        norm = np.linalg.norm(pt0 - pt1, ord=None, axis=2)
-        min_dist0 = np.min(norm, axis=1)
-        min_dist1 = np.min(norm, axis=0)
-        gt_num_list = []
-        for err_thld in self.err_thld:
-            gt_num0 = np.sum(min_dist0 <= err_thld)
-            gt_num1 = np.sum(min_dist1 <= err_thld)
-            gt_num = (gt_num0 + gt_num1) / 2
-            gt_num_list.append(gt_num)
+        # 超过最大阈值的距离不需要精确值, 查询时以此剪枝, 返回inf
+        upper_bound = np.max(self.err_thld) * (1 + 1e-6) + 1e-6
+        min_dist0, _ = cKDTree(test_coord).query(proj_ref_coord, k=1, distance_upper_bound=upper_bound)
+        min_dist1, _ = cKDTree(proj_ref_coord).query(test_coord, k=1, distance_upper_bound=upper_bound)
+        gt_num0 = np.searchsorted(np.sort(min_dist0), self.err_thld, side='right')
+        gt_num1 = np.searchsorted(np.sort(min_dist1), self.err_thld, side='right')
+        gt_num_list = list((gt_num0 + gt_num1) / 2)
         return gt_num_list
 
     def compute_homography_accuracy(self, ref_coord, test_coord, ref_img_shape, putative_matches, gt_homo, scaling=1.):
-        ref_coord = np.float32([ref_coord[m.queryIdx] for m in putative_matches]) / scaling
-        test_coord = np.float32([test_coord[m.trainIdx] for m in putative_matches]) / scaling
+        ref_coord = ref_coord[putative_matches[:, 0]].astype(np.float32) / scaling
+        test_coord = test_coord[putative_matches[:, 1]].astype(np.float32) / scaling
 
         pred_homo, _ = cv2.findHomography(ref_coord, test_coord, cv2.RANSAC)
         if pred_homo is None:
@@ -148,64 +179,208 @@ class Evaluator(object):
                 file.write('avg_homography_accuracy: %.4f\n' % avg_stats[6])
 
 
-def evaluate(read_feats, dataset_path, evaluator):
+class FeatureReader(object):
+    """
+    evaluate()所用的read_feats, 返回(shape, keypoints, descriptors)
+    path以.feats结尾时从导出的特征库中读取, 返回内存映射的只读视图而不拷贝; 否则读取逐图像的
+    <path>/<seq_name>/<im_idx>.<extension>.<tag>文件。当前序列参考图像(im_idx=1)的特征只读取一次,
+    bytes_read统计读取的数据量。以fp16/int8/pca编码导出的描述子在这里解码, pca编码需要给出投影
+    """
+
+    def __init__(self, path, tag=None, extension='ppm', pca=None):
+        self.path = str(path)
+        self.tag = tag
+        self.extension = extension
+        self.pca = pca
+        if self.path.endswith('.feats'):
+            self.store = FeatureStoreReader(self.path)
+        else:
+            self.store = None
+        self.bytes_read = 0
+        self.ref_name = None
+        self.ref_feats = None
+
+    def __call__(self, seq_name, im_idx):
+        if im_idx == 1 and seq_name == self.ref_name:
+            return self.ref_feats
+
+        if self.store is not None:
+            feats = self.store.read(seq_name, str(im_idx))
+            self.bytes_read += feats['keypoints'].nbytes + feats['descriptors'].nbytes
+        else:
+            feats_path = os.path.join(self.path, seq_name, '%d.%s.%s' % (im_idx, self.extension, self.tag))
+            feats = np.load(feats_path)
+            self.bytes_read += os.path.getsize(feats_path)
+        result = (feats['shape'], feats['keypoints'], decode_descriptors(feats, self.pca))
+
+        if im_idx == 1:
+            self.ref_name = seq_name
+            self.ref_feats = result
+        return result
+
+
+def evaluate_pair(ref_feats, test_feats, gt_homo, evaluator):
+    """
+    评测一对图像, 返回该图像对在序列统计量中所占的[len(evaluator.err_thld), 8]部分
+    """
+    ref_img_shape, ref_kpts, ref_descs = ref_feats
+    test_img_shape, test_kpts, test_descs = test_feats
+
+    # get MMA
+    num_feat = min(ref_kpts.shape[0], test_kpts.shape[0])
+    if num_feat > 0:
+        mma_putative_matches = evaluator.feature_matcher(ref_descs, test_descs)
+    else:
+        mma_putative_matches = np.zeros((0, 2), dtype=np.int64)
+    mma_inlier_matches_list = evaluator.get_inlier_matches(ref_kpts, test_kpts, mma_putative_matches, gt_homo)
+    num_mma_putative = len(mma_putative_matches)
+    num_mma_inlier_list = [len(mma_inlier_matches) for mma_inlier_matches in mma_inlier_matches_list]
+
+    # get covisible keypoints
+    ref_mask, test_mask = evaluator.get_covisible_mask(ref_kpts, test_kpts,
+                                                       ref_img_shape, test_img_shape,
+                                                       gt_homo)
+    cov_ref_coord, cov_test_coord = ref_kpts[ref_mask], test_kpts[test_mask]
+    cov_ref_feat, cov_test_feat = ref_descs[ref_mask], test_descs[test_mask]
+    num_cov_feat = (cov_ref_coord.shape[0] + cov_test_coord.shape[0]) / 2
+
+    # get gt matches
+    gt_num_list = evaluator.get_gt_matches(cov_ref_coord, cov_test_coord, gt_homo)
+    # establish putative matches
+    if num_cov_feat > 0:
+        putative_matches = evaluator.feature_matcher(cov_ref_feat, cov_test_feat)
+    else:
+        putative_matches = np.zeros((0, 2), dtype=np.int64)
+    num_putative = max(len(putative_matches), 1)
+
+    # get homography accuracy
+    correctness_list = evaluator.compute_homography_accuracy(cov_ref_coord, cov_test_coord, ref_img_shape,
+                                                        putative_matches, gt_homo)
+    # get inlier matches
+    inlier_matches_list = evaluator.get_inlier_matches(cov_ref_coord, cov_test_coord, putative_matches, gt_homo)
+    num_inlier_list = [len(inlier_matches) for inlier_matches in inlier_matches_list]
+
+    return np.stack([np.array((1,  # counter
+               num_feat,  # feature number
+               gt_num_list[i] / max(num_cov_feat, 1),  # repeatability
+               num_inlier_list[i] / max(num_putative, 1),  # precision
+               num_inlier_list[i] / max(num_cov_feat, 1),  # matching score
+               num_inlier_list[i] / max(gt_num_list[i], 1),  # recall
+               num_mma_inlier_list[i] / max(num_mma_putative, 1),
+               correctness_list[i])) / 5  # MMA
+     for i in range(len(evaluator.err_thld))
+     ], axis=0)  # [len(evaluator.err_thld), 8]
+
+
+def evaluate_sequence(read_feats, dataset_path, seq_name, evaluator, cache=None):
+    """
+    评测一个序列中参考图像与其余5幅图像的匹配, 返回该序列的[len(evaluator.err_thld), 8]统计量
+    给出cache(ResultCache)时, 特征与设置都未变化的图像对直接读取缓存的结果
+    """
+    ref_feats = read_feats(seq_name, 1)
+    if cache is not None:
+        ref_hasher = cache.update_hash(cache.hash_settings(evaluator.settings()), *ref_feats)
+
+    eval_stats = np.zeros((len(evaluator.err_thld), 8), np.float32)
+
+    # print(seq_idx, seq_name)
+
+    for im_idx in range(2, 7):
+        test_feats = read_feats(seq_name, im_idx)
+        gt_homo = np.loadtxt(os.path.join(dataset_path, seq_name, "H_1_" + str(im_idx)))
+
+        if cache is None:
+            eval_stats += evaluate_pair(ref_feats, test_feats, gt_homo, evaluator)
+            continue
+
+        key = cache.update_hash(ref_hasher.copy(), gt_homo, *test_feats).hexdigest()
+        pair_stats = cache.get(key)
+        if pair_stats is None:
+            pair_stats = evaluate_pair(ref_feats, test_feats, gt_homo, evaluator)
+            cache.put(key, pair_stats)
+        eval_stats += pair_stats
+
+    return eval_stats
+
+
+# 多进程评测时由fork继承的上下文, read_feats可以是闭包或持有内存映射的对象, 不需要能被pickle
+_worker_context = {}
+
+
+def _init_worker():
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+    _worker_context['evaluator'].device = torch.device('cpu:0')
+
+
+def _evaluate_sequence_worker(seq_name):
+    read_feats = _worker_context['read_feats']
+    evaluator = _worker_context['evaluator']
+    cache = _worker_context['cache']
+    bytes_before = getattr(read_feats, 'bytes_read', 0)
+    hits_before, misses_before = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    start_time = time.time()
+    eval_stats = evaluate_sequence(read_feats, _worker_context['dataset_path'], seq_name, evaluator, cache)
+    elapsed = time.time() - start_time
+    bytes_read = getattr(read_feats, 'bytes_read', 0) - bytes_before
+    if cache is not None:
+        cache_count = (cache.hits - hits_before, cache.misses - misses_before)
+    else:
+        cache_count = (0, 0)
+    return seq_name, eval_stats, os.getpid(), elapsed, bytes_read, cache_count
+
+
+def _evaluate_parallel(read_feats, dataset_path, evaluator, seq_names, num_workers, cache=None):
+    """
+    以num_workers个进程按序列分片评测, 返回{seq_name: eval_stats}。
+    子进程用单线程cpu做匹配, 避免在fork出的进程中使用cuda以及多个进程争抢线程
+    """
+    _worker_context.update(read_feats=read_feats, dataset_path=dataset_path, evaluator=evaluator, cache=cache)
+    seq_stats = {}
+    worker_time = {}
+    worker_seq_num = {}
+    try:
+        with mp.get_context('fork').Pool(num_workers, initializer=_init_worker) as pool:
+            results = pool.imap_unordered(_evaluate_sequence_worker, seq_names)
+            for seq_name, eval_stats, pid, elapsed, bytes_read, cache_count in tqdm(results, total=len(seq_names)):
+                seq_stats[seq_name] = eval_stats
+                worker_time[pid] = worker_time.get(pid, 0.) + elapsed
+                worker_seq_num[pid] = worker_seq_num.get(pid, 0) + 1
+                if hasattr(read_feats, 'bytes_read'):
+                    read_feats.bytes_read += bytes_read
+                if cache is not None:
+                    cache.hits += cache_count[0]
+                    cache.misses += cache_count[1]
+    finally:
+        _worker_context.clear()
+
+    for i, pid in enumerate(sorted(worker_time.keys())):
+        print('worker %d (pid %d): %d sequences, %.2fs' % (i, pid, worker_seq_num[pid], worker_time[pid]))
+    return seq_stats
+
+
+def evaluate(read_feats, dataset_path, evaluator, num_workers=1, cache=None):
+    """
+    Args:
+        read_feats: read_feats(seq_name, im_idx)返回(shape, keypoints, descriptors)
+        dataset_path: hpatches-sequences-release目录
+        evaluator: Evaluator, 统计量累加到evaluator.stats
+        num_workers: 大于1时按序列分给多个进程并行评测(依赖fork, 仅限linux),
+            各序列的统计量仍按序列名顺序累加, 结果与单进程一致
+        cache: ResultCache, 缓存逐图像对的结果, 只重新计算特征或设置发生变化的图像对
+    """
     seq_names = sorted(os.listdir(dataset_path))
 
-    for seq_idx, seq_name in tqdm(enumerate(seq_names), total=len(seq_names)):
-        ref_img_shape, ref_kpts, ref_descs = read_feats(seq_name, 1)
-
-        eval_stats = np.zeros((len(evaluator.err_thld), 8), np.float32)
-
-        # print(seq_idx, seq_name)
-
-        for im_idx in range(2, 7):
-            test_img_shape, test_kpts, test_descs = read_feats(seq_name, im_idx)
-            gt_homo = np.loadtxt(os.path.join(dataset_path, seq_name, "H_1_" + str(im_idx)))
-
-            # get MMA
-            num_feat = min(ref_kpts.shape[0], test_kpts.shape[0])
-            if num_feat > 0:
-                mma_putative_matches = evaluator.feature_matcher(ref_descs, test_descs)
-            else:
-                mma_putative_matches = []
-            mma_inlier_matches_list = evaluator.get_inlier_matches(ref_kpts, test_kpts, mma_putative_matches, gt_homo)
-            num_mma_putative = len(mma_putative_matches)
-            num_mma_inlier_list = [len(mma_inlier_matches) for mma_inlier_matches in mma_inlier_matches_list]
-
-            # get covisible keypoints
-            ref_mask, test_mask = evaluator.get_covisible_mask(ref_kpts, test_kpts,
-                                                               ref_img_shape, test_img_shape,
-                                                               gt_homo)
-            cov_ref_coord, cov_test_coord = ref_kpts[ref_mask], test_kpts[test_mask]
-            cov_ref_feat, cov_test_feat = ref_descs[ref_mask], test_descs[test_mask]
-            num_cov_feat = (cov_ref_coord.shape[0] + cov_test_coord.shape[0]) / 2
-
-            # get gt matches
-            gt_num_list = evaluator.get_gt_matches(cov_ref_coord, cov_test_coord, gt_homo)
-            # establish putative matches
-            if num_cov_feat > 0:
-                putative_matches = evaluator.feature_matcher(cov_ref_feat, cov_test_feat)
-            else:
-                putative_matches = []
-            num_putative = max(len(putative_matches), 1)
-
-            # get homography accuracy
-            correctness_list = evaluator.compute_homography_accuracy(cov_ref_coord, cov_test_coord, ref_img_shape,
-                                                                putative_matches, gt_homo)
-            # get inlier matches
-            inlier_matches_list = evaluator.get_inlier_matches(cov_ref_coord, cov_test_coord, putative_matches, gt_homo)
-            num_inlier_list = [len(inlier_matches) for inlier_matches in inlier_matches_list]
-
-            eval_stats += np.stack([np.array((1,  # counter
-                       num_feat,  # feature number
-                       gt_num_list[i] / max(num_cov_feat, 1),  # repeatability
-                       num_inlier_list[i] / max(num_putative, 1),  # precision
-                       num_inlier_list[i] / max(num_cov_feat, 1),  # matching score
-                       num_inlier_list[i] / max(gt_num_list[i], 1),  # recall
-                       num_mma_inlier_list[i] / max(num_mma_putative, 1),
-                       correctness_list[i])) / 5  # MMA
-             for i in range(len(evaluator.err_thld))
-             ], axis=0)  # [len(evaluator.err_thld), 8]
+    if num_workers > 1:
+        seq_stats = _evaluate_parallel(read_feats, dataset_path, evaluator, seq_names, num_workers, cache)
+    else:
+        seq_stats = None
+
+    for seq_idx, seq_name in tqdm(enumerate(seq_names), total=len(seq_names), disable=seq_stats is not None):
+        if seq_stats is not None:
+            eval_stats = seq_stats[seq_name]
+        else:
+            eval_stats = evaluate_sequence(read_feats, dataset_path, seq_name, evaluator, cache)
 
         # print(int(eval_stats[1]), eval_stats[2:])
         evaluator.stats['all_eval_stats'] += eval_stats
@@ -217,6 +392,10 @@ def evaluate(read_feats, dataset_path, evaluator):
     # evaluator.print_stats('i_eval_stats')
     # evaluator.print_stats('v_eval_stats')
     evaluator.print_stats('all_eval_stats')
+    if hasattr(read_feats, 'bytes_read'):
+        print('feature bytes read: %.2f MB' % (read_feats.bytes_read / 1024. / 1024.))
+    if cache is not None:
+        print('result cache: %d pairs reused, %d pairs computed' % (cache.hits, cache.misses))
 
     err_thld = evaluator.err_thld
     i_eval_stats = evaluator.stats['i_eval_stats'].T  # [8, 15]
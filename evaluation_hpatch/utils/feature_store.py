@@ -0,0 +1,91 @@
+#
+# Created  on 2021/3/2
+#
+import os
+import json
+import threading
+
+import numpy as np
+
+
+class FeatureStoreWriter(object):
+    """
+    将一次导出的所有图像特征追加写入同一个数据文件, 代替每幅图像一个.npz文件
+    数据文件<path>中顺序存放各数组的原始字节(按ALIGN字节对齐), 索引文件<path>.index每行一条json记录:
+        {"folder": ..., "image": ..., "fields": {name: [offset, dtype, shape]}}
+    两个文件都只追加, 同一(folder, image)重复写入时以最后一条为准
+    """
+    ALIGN = 64
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.data_file = open(self.path, 'ab')
+        self.index_file = open(self.path + '.index', 'a')
+        self.offset = self.data_file.tell()
+        self.lock = threading.Lock()
+
+    def append(self, folder_name, image_name, predictions):
+        with self.lock:
+            fields = {}
+            for name, value in predictions.items():
+                value = np.ascontiguousarray(value)
+                pad = (-self.offset) % self.ALIGN
+                if pad > 0:
+                    self.data_file.write(b'\0' * pad)
+                    self.offset += pad
+                fields[name] = [self.offset, value.dtype.str, list(value.shape)]
+                self.data_file.write(value.tobytes())
+                self.offset += value.nbytes
+            # 数据写完后再写索引, 中断时索引中不会出现不完整的记录
+            self.data_file.flush()
+            self.index_file.write(json.dumps({'folder': folder_name, 'image': image_name, 'fields': fields}) + '\n')
+            self.index_file.flush()
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FeatureStoreReader(object):
+    """
+    以内存映射方式读取FeatureStoreWriter写出的特征文件, read返回的数组是数据文件的只读视图, 不做拷贝
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.index = {}
+        with open(self.path + '.index', 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.index[(entry['folder'], entry['image'])] = entry['fields']
+
+        if os.path.getsize(self.path) > 0:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def read(self, folder_name, image_name):
+        fields = self.index[(folder_name, image_name)]
+        return {name: self._view(*field) for name, field in fields.items()}
+
+    def _view(self, offset, dtype, shape):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        return np.frombuffer(self.data, dtype=dtype, count=count, offset=offset).reshape(shape)
@@ -0,0 +1,54 @@
+#
+# Created  on 2021/3/6
+#
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+class ResultCache(object):
+    """
+    以内容寻址的逐图像对评测结果缓存, 可在多次运行间复用
+    key由参考图像与测试图像的特征内容、单应真值以及评测设置共同哈希得到, 每个key对应
+    <cache_dir>/<key[:2]>/<key>.npy中的一个[len(err_thld), 8]统计量。重新导出部分序列后,
+    只有特征发生变化的图像对会被重新计算
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = str(cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_settings(settings):
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8'))
+
+    @staticmethod
+    def update_hash(hasher, *arrays):
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            hasher.update(('%s%s' % (array.dtype.str, array.shape)).encode('utf-8'))
+            hasher.update(array.tobytes())
+        return hasher
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.load(path)
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名, 多个评测进程同时写同一个key时不会读到不完整的文件
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, value)
+        os.replace(tmp_path, path)
@@ -9,8 +9,14 @@ import torch.nn.functional as f
 class Matcher(object):
 
     def __init__(self, dtype='float'):
+        """
+        Args:
+            dtype: float: 欧氏距离; unit: 单位长度描述子, 用float32内积代替距离; binary: 汉明距离
+        """
         if dtype == 'float':
             self.compute_desp_dist = self._compute_desp_dist
+        elif dtype == 'unit':
+            self.compute_desp_dist = self._compute_desp_dist_unit
         elif dtype == 'binary':
             self.compute_desp_dist = self._compute_desp_dist_binary
         else:
@@ -18,33 +24,35 @@ class Matcher(object):
 
     def __call__(self, point_0, desp_0, point_1, desp_1):
         dist_0_1 = self.compute_desp_dist(desp_0, desp_1)  # [n,m]
-        dist_1_0 = dist_0_1.transpose((1, 0))  # [m,n]
         nearest_idx_0_1 = np.argmin(dist_0_1, axis=1)  # [n]
-        nearest_idx_1_0 = np.argmin(dist_1_0, axis=1)  # [m]
-        matched_src = []
-        matched_tgt = []
-        for i, idx_0_1 in enumerate(nearest_idx_0_1):
-            if i == nearest_idx_1_0[idx_0_1]:
-                matched_src.append(point_0[i])
-                matched_tgt.append(point_1[idx_0_1])
-        if len(matched_src) <= 4:
+        nearest_idx_1_0 = np.argmin(dist_0_1, axis=0)  # [m]
+        # 双向最近邻检查
+        matched_idx = np.nonzero(nearest_idx_1_0[nearest_idx_0_1] == np.arange(dist_0_1.shape[0]))[0]
+        if matched_idx.shape[0] <= 4:
             print("There exist too little matches")
             # assert False
             return None
-        if len(matched_src) != 0:
-            matched_src = np.stack(matched_src, axis=0)
-            matched_tgt = np.stack(matched_tgt, axis=0)
+        matched_src = point_0[matched_idx]
+        matched_tgt = point_1[nearest_idx_0_1[matched_idx]]
         return matched_src, matched_tgt
 
     @staticmethod
     def _compute_desp_dist(desp_0, desp_1):
         # desp_0:[n,256], desp_1:[m,256]
-        square_norm_0 = (np.linalg.norm(desp_0, axis=1, keepdims=True)) ** 2  # [n,1]
-        square_norm_1 = (np.linalg.norm(desp_1, axis=1, keepdims=True).transpose((1, 0))) ** 2  # [1,m]
+        # 只用于求最近邻, 返回距离的平方, 省去开方
+        square_norm_0 = np.sum(desp_0 ** 2, axis=1, keepdims=True)  # [n,1]
+        square_norm_1 = np.sum(desp_1 ** 2, axis=1, keepdims=True).transpose((1, 0))  # [1,m]
         xty = np.matmul(desp_0, desp_1.transpose((1, 0)))  # [n,m]
-        dist = np.sqrt((square_norm_0 + square_norm_1 - 2 * xty + 1e-4))
+        dist = square_norm_0 + square_norm_1 - 2 * xty
         return dist
 
+    @staticmethod
+    def _compute_desp_dist_unit(desp_0, desp_1):
+        # desp_0:[n,256], desp_1:[m,256], 均为单位长度, 距离的平方为2-2xty, 最近邻即内积最大者
+        desp_0 = np.asarray(desp_0, dtype=np.float32)
+        desp_1 = np.asarray(desp_1, dtype=np.float32)
+        return -np.matmul(desp_0, desp_1.transpose((1, 0)))
+
     @staticmethod
     def _compute_desp_dist_binary(desp_0, desp_1):
         # desp_0:[n,256], desp_1[m,256]
@@ -52,6 +60,84 @@ class Matcher(object):
         return dist_0_1
 
 
+def mnn_matcher_chunked(descriptors_a, descriptors_b, chunk_size=4096, fp16=False, ratio=None):
+    """
+    分块计算相似度矩阵的双向最近邻匹配，逐块更新两个方向上的最大相似度及其下标，
+    峰值显存/内存为O(chunk_size^2 + n + m)，与n*m无关。不做ratio test时结果与一次性计算完整相似度矩阵相同
+    Args:
+        descriptors_a: [n,d] tensor
+        descriptors_b: [m,d] tensor, 与descriptors_a在同一设备上
+        chunk_size: 每块的行数/列数
+        fp16: 在cuda上用半精度计算矩阵乘，累积的最大值仍为float32
+        ratio: 匹配点与除它之外最近点的欧氏距离比阈值，None表示不做ratio test。
+            MTLDesc的描述子归一化后还乘了注意力权重，并非单位长度，因此距离由实际的模长换算: |a|^2+|b|^2-2s
+    Returns:
+        matches: [k,2] numpy数组, 每行为(idx_a, idx_b)
+    """
+    device = descriptors_a.device
+    n, m = descriptors_a.shape[0], descriptors_b.shape[0]
+    if n == 0 or m == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    dtype = torch.float16 if (fp16 and descriptors_a.is_cuda) else torch.float32
+    if ratio is not None:
+        square_norm_a = torch.sum(descriptors_a.float() ** 2, dim=1)  # [n]
+        square_norm_b = torch.sum(descriptors_b.float() ** 2, dim=1)  # [m]
+        # 每行距离平方中与a无关的部分|b|^2-2s的最小、次小值, 及最小值的下标
+        best_dist = torch.full((n,), float('inf'), device=device)
+        second_dist = torch.full((n,), float('inf'), device=device)
+        nn_dist = torch.zeros((n,), dtype=torch.long, device=device)
+    descriptors_a = descriptors_a.to(dtype)
+    descriptors_b = descriptors_b.to(dtype)
+
+    best_ab = torch.full((n,), -float('inf'), device=device)
+    nn_ab = torch.zeros((n,), dtype=torch.long, device=device)
+    best_ba = torch.full((m,), -float('inf'), device=device)
+    nn_ba = torch.zeros((m,), dtype=torch.long, device=device)
+
+    for i in range(0, n, chunk_size):
+        chunk_a = descriptors_a[i:i + chunk_size]
+        rows = slice(i, i + chunk_a.shape[0])
+        for j in range(0, m, chunk_size):
+            chunk_b = descriptors_b[j:j + chunk_size]
+            cols = slice(j, j + chunk_b.shape[0])
+            sim = torch.matmul(chunk_a, chunk_b.t()).float()  # [c,c']
+
+            # a -> b, 严格大于时才更新, 与torch.max一样保留最先出现的最大值
+            val, arg = torch.max(sim, dim=1)
+            better = val > best_ab[rows]
+            best_ab[rows] = torch.where(better, val, best_ab[rows])
+            nn_ab[rows] = torch.where(better, arg + j, nn_ab[rows])
+
+            if ratio is not None:
+                dist = square_norm_b[cols][None, :] - 2. * sim
+                top_val, top_arg = torch.topk(dist, min(2, dist.shape[1]), dim=1, largest=False)
+                val, arg = top_val[:, 0], top_arg[:, 0]
+                val2 = top_val[:, 1] if dist.shape[1] > 1 else torch.full_like(val, float('inf'))
+                better = val < best_dist[rows]
+                second_dist[rows] = torch.where(better, torch.min(best_dist[rows], val2),
+                                                torch.min(second_dist[rows], val))
+                best_dist[rows] = torch.where(better, val, best_dist[rows])
+                nn_dist[rows] = torch.where(better, arg + j, nn_dist[rows])
+
+            # b -> a
+            val, arg = torch.max(sim, dim=0)
+            better = val > best_ba[cols]
+            best_ba[cols] = torch.where(better, val, best_ba[cols])
+            nn_ba[cols] = torch.where(better, arg + i, nn_ba[cols])
+
+    ids_a = torch.arange(0, n, device=device)
+    mask = (ids_a == nn_ba[nn_ab])
+    if ratio is not None:
+        # 匹配点的距离, 以及除匹配点外最近点的距离; 单位长度描述子时即最近邻与次近邻的距离
+        dist_1 = torch.sqrt(torch.clamp(square_norm_a + square_norm_b[nn_ab] - 2. * best_ab, min=0.))
+        other = torch.where(nn_dist == nn_ab, second_dist, best_dist)
+        dist_2 = torch.sqrt(torch.clamp(square_norm_a + other, min=0.))
+        mask = mask & (dist_1 <= ratio * dist_2)
+    matches = torch.stack([ids_a[mask], nn_ab[mask]])
+    return matches.t().detach().cpu().numpy()
+
+
 def spatial_nms(prob, kernel_size=9):
     """
     利用max_pooling对预测的特征点的概率图进行非极大值抑制
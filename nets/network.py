@@ -1,10 +1,25 @@
+import inspect
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as f
 from nets.vit.vit_seg_modeling import *
 from nets.vit.vit_seg_modeling import PatchTransfomer
+from nets.vit import vit_seg_configs
+
+# torch 1.3之前的grid_sample没有align_corners参数, 行为等同于align_corners=True; 之后默认为False
+_GRID_SAMPLE_ALIGN_CORNERS = 'align_corners' not in inspect.signature(f.grid_sample).parameters
+
+
 class MTLDesc(nn.Module):
-    def __init__(self):
+    def __init__(self, attention_backend='eager', context_layers=12, context_mlp_dim=2048):
+        """
+        Args:
+            attention_backend: 全局上下文transformer的注意力实现, eager或sdpa(合并qkv的scaled_dot_product_attention),
+                两者参数可以互相加载
+            context_layers, context_mlp_dim: 全局上下文transformer的层数及MLP宽度, 默认与原始模型一致,
+                更小的设置需要用ContextDistillTrainer从原始模型蒸馏
+        """
         super(MTLDesc, self).__init__()
         self.relu = torch.nn.ReLU(inplace=True)
         self.pool = torch.nn.MaxPool2d(kernel_size=2, stride=2)
@@ -41,7 +56,11 @@ class MTLDesc(nn.Module):
         self.active = f.softplus
         self.conv_avg = nn.Conv2d(128, 384, kernel_size=3, stride=1, padding=1)
 
-        self.transfomer=PatchTransfomer(img_size=64,in_channels=128)
+        transformer_config = vit_seg_configs.get_l16_config()
+        transformer_config.transformer.attention_backend = attention_backend
+        transformer_config.transformer.num_layers = context_layers
+        transformer_config.transformer.mlp_dim = context_mlp_dim
+        self.transfomer=PatchTransfomer(config=transformer_config,img_size=64,in_channels=128)
         self.pool_size=64
         self.adapool = nn.AdaptiveAvgPool2d((self.pool_size, self.pool_size))
         self.mask=nn.Conv2d(128,1,kernel_size=3,stride=1,padding=1)
@@ -54,7 +73,7 @@ class MTLDesc(nn.Module):
             if isinstance(m, nn.Conv2d):
                 nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
 
-    def forward(self, x):
+    def _encode(self, x):
         x = self.relu(self.conv1a(x))
         c1 = self.relu(self.conv1b(x))  # 64
 
@@ -69,6 +88,19 @@ class MTLDesc(nn.Module):
         c4 = self.pool(c3)
         c4 = self.relu(self.conv4a(c4))
         c4 = self.relu(self.conv4b(c4))  # 128
+        return c1, c2, c3, c4
+
+    def _global_context(self, top):
+        # top: adapool后的[b,128,64,64]
+        mask=self.relu(self.mask(top))
+        avg=self.transfomer(top)
+        return avg, mask
+
+    def _decode(self, c1, c2, c3, c4, avg, mask, refine=True):
+        """
+        avg, mask: 已插值到1/4分辨率的全局上下文及其权重
+        refine: False时返回dilated卷积细化之前的描述子, 由refine_descriptor_sparse只在需要的位置细化
+        """
         #top=c4
         # KeyPoint Map
         heatmap1 = self.heatmap1(c1)
@@ -94,18 +126,173 @@ class MTLDesc(nn.Module):
         attmap = self.scalemap(meanmap)
         attmap = self.active(attmap)
 
-        # Global Context
-        top=self.adapool(c4)
-        mask=self.relu(self.mask(top))
-        avg=self.transfomer(top)
-        avg=f.interpolate(avg,des_size,mode='bilinear')
-        mask=f.interpolate(mask,des_size,mode='bilinear')
         descriptor = feature
         descriptor = self.conv_des(descriptor)+avg*mask
+        if refine:
+            descriptor = self._refine_descriptor(descriptor)
+        return heatmap, descriptor,attmap
+
+    def _refine_descriptor(self, descriptor):
         descriptor_1 = self.conv_des_1(descriptor)
         descriptor_2 = self.conv_des_2(descriptor)
         descriptor_3 = self.conv_des_3(descriptor)
         descriptor_4 = self.conv_des_4(descriptor)
         descriptor_refine = torch.cat((descriptor_1, descriptor_2, descriptor_3, descriptor_4), dim=1)
         descriptor = descriptor + descriptor_refine
-        return heatmap, descriptor,attmap
+        return descriptor
+
+    def refine_descriptor_sparse(self, descriptor, grid, chunk_size=8192):
+        """
+        只在grid_sample会读取到的像素上计算conv_des_1..4的细化, 其余位置保持细化前的值。
+        用返回的特征图在grid上双线性采样, 与稠密细化后再采样的结果相同
+        Args:
+            descriptor: [1,128,h,w] forward(x, refine=False)返回的细化前的描述子
+            grid: [1,n,1,2] 归一化到[-1,1]的采样坐标(x,y), 与之后grid_sample所用的相同
+        Returns:
+            descriptor: [1,128,h,w]
+        """
+        assert descriptor.shape[0] == 1
+        height, width = descriptor.shape[2], descriptor.shape[3]
+        grid = grid.reshape(-1, 2)
+
+        # 双线性采样的4个邻近像素, 坐标换算与默认参数的grid_sample一致
+        pixels = []
+        for size, coord in ((width, grid[:, 0]), (height, grid[:, 1])):
+            if _GRID_SAMPLE_ALIGN_CORNERS:
+                coord = torch.floor((coord + 1) / 2 * (size - 1))
+            else:
+                coord = torch.floor(((coord + 1) * size - 1) / 2)
+            pixels.append(torch.stack((coord, coord + 1), dim=1).long())
+        xs = pixels[0][:, [0, 1, 0, 1]].reshape(-1)
+        ys = pixels[1][:, [0, 0, 1, 1]].reshape(-1)
+        valid = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        keys = torch.unique(ys[valid] * width + xs[valid])
+        ys, xs = keys // width, keys % width
+
+        convs = (self.conv_des_1, self.conv_des_2, self.conv_des_3, self.conv_des_4)
+        pad = max(conv.dilation[0] for conv in convs)
+        padded = f.pad(descriptor[0], [pad, pad, pad, pad])  # 与卷积的zero padding一致
+        padded_width = padded.shape[2]
+        padded = padded.reshape(padded.shape[0], -1)  # [128,(h+2p)*(w+2p)]
+        # 各卷积3x3个tap在展开后的特征图上的偏移, 顺序与weight.reshape(32, 128*3*3)的(c,ky,kx)一致
+        offsets = []
+        for conv in convs:
+            dilation = conv.dilation[0]
+            tap = torch.arange(-1, 2, device=descriptor.device) * dilation
+            offsets.append((tap[:, None] * padded_width + tap[None, :]).reshape(-1))
+        offsets = torch.stack(offsets, dim=0)  # [4,9]
+
+        refined = []
+        for start in range(0, keys.shape[0], chunk_size):
+            center = (ys[start:start + chunk_size] + pad) * padded_width + xs[start:start + chunk_size] + pad
+            outputs = []
+            for conv, offset in zip(convs, offsets):
+                index = (offset[:, None] + center[None, :]).reshape(-1)  # [9*k]
+                taps = torch.index_select(padded, 1, index).reshape(padded.shape[0] * 9, -1)  # [128*3*3,k]
+                weight = conv.weight.reshape(conv.out_channels, -1)  # [32,128*3*3]
+                outputs.append(torch.matmul(weight, taps) + conv.bias[:, None])
+            refined.append(torch.cat(outputs, dim=0))
+
+        descriptor = descriptor.clone()
+        if keys.shape[0] > 0:
+            descriptor[0, :, ys, xs] += torch.cat(refined, dim=1)
+        return descriptor
+
+    def forward(self, x, refine=True):
+        """
+        refine: False时返回细化前的描述子, 配合refine_descriptor_sparse只在特征点附近细化
+        """
+        c1, c2, c3, c4 = self._encode(x)
+
+        # Global Context
+        des_size = c3.shape[2:]  # 1/4 HxW
+        top=self.adapool(c4)
+        avg, mask = self._global_context(top)
+        avg=f.interpolate(avg,des_size,mode='bilinear')
+        mask=f.interpolate(mask,des_size,mode='bilinear')
+        return self._decode(c1, c2, c3, c4, avg, mask, refine=refine)
+
+    def forward_tiled(self, x, tile_size=1024, halo=128):
+        """
+        分块前向, 用于显存放不下整幅图像的超大图像, 峰值显存只与tile_size+2*halo有关(输出的特征图除外)
+        第一遍逐块只计算c4, 用池化矩阵把各块的c4累加为整幅图像的adapool结果, 全局上下文分支只在这个64x64的
+        全图视图上计算一次; 第二遍逐块完整前向, 全局上下文用插值矩阵只插值到当前块的区域, 各块去掉halo后拼接。
+        halo需要覆盖编码器及dilation=18的描述子卷积的感受野(约120像素), 默认128
+        Args:
+            x: [b,3,h,w], h,w为16的整数倍
+            tile_size, halo: 原图分辨率下的块大小及重叠边界, 均需为16的整数倍
+        Returns:
+            与forward相同的heatmap, descriptor, attmap
+        """
+        assert tile_size % 16 == 0 and halo % 16 == 0
+        height, width = x.shape[2], x.shape[3]
+        if height <= tile_size and width <= tile_size:
+            return self.forward(x)
+        tiles = [(y, min(y + tile_size, height), x0, min(x0 + tile_size, width))
+                 for y in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+
+        def expand(y0, y1, x0, x1):
+            return max(y0 - halo, 0), min(y1 + halo, height), max(x0 - halo, 0), min(x1 + halo, width)
+
+        # 第一遍: 累加整幅图像c4的自适应平均池化
+        pool_y = _adaptive_pool_matrix(height // 8, self.pool_size, x.device)  # [64,h/8]
+        pool_x = _adaptive_pool_matrix(width // 8, self.pool_size, x.device)
+        top = 0
+        for y0, y1, x0, x1 in tiles:
+            ey0, ey1, ex0, ex1 = expand(y0, y1, x0, x1)
+            c4 = self._encode(x[:, :, ey0:ey1, ex0:ex1])[3]
+            c4 = c4[:, :, (y0 - ey0) // 8:(y1 - ey0) // 8, (x0 - ex0) // 8:(x1 - ex0) // 8]
+            top = top + torch.matmul(torch.matmul(pool_y[:, y0 // 8:y1 // 8], c4),
+                                     pool_x[:, x0 // 8:x1 // 8].t())
+        avg, mask = self._global_context(top)
+        # avg与mask的分辨率不同, 各自插值到1/4分辨率
+        avg_y = _interpolate_matrix(avg.shape[2], height // 4, x.device)  # [h/4,h']
+        avg_x = _interpolate_matrix(avg.shape[3], width // 4, x.device)
+        mask_y = _interpolate_matrix(mask.shape[2], height // 4, x.device)
+        mask_x = _interpolate_matrix(mask.shape[3], width // 4, x.device)
+
+        # 第二遍: 逐块前向并拼接
+        heatmap = x.new_zeros((x.shape[0], 1, height, width))
+        descriptor = x.new_zeros((x.shape[0], self.conv_des.out_channels, height // 4, width // 4))
+        attmap = x.new_zeros((x.shape[0], 1, height // 4, width // 4))
+        for y0, y1, x0, x1 in tiles:
+            ey0, ey1, ex0, ex1 = expand(y0, y1, x0, x1)
+            c1, c2, c3, c4 = self._encode(x[:, :, ey0:ey1, ex0:ex1])
+            rows, cols = slice(ey0 // 4, ey1 // 4), slice(ex0 // 4, ex1 // 4)
+            tile_avg = torch.matmul(torch.matmul(avg_y[rows], avg), avg_x[cols].t())
+            tile_mask = torch.matmul(torch.matmul(mask_y[rows], mask), mask_x[cols].t())
+            tile_heatmap, tile_descriptor, tile_attmap = self._decode(c1, c2, c3, c4, tile_avg, tile_mask)
+
+            heatmap[:, :, y0:y1, x0:x1] = tile_heatmap[:, :, y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0]
+            qy0, qy1, qx0, qx1 = (y0 - ey0) // 4, (y1 - ey0) // 4, (x0 - ex0) // 4, (x1 - ex0) // 4
+            descriptor[:, :, y0 // 4:y1 // 4, x0 // 4:x1 // 4] = tile_descriptor[:, :, qy0:qy1, qx0:qx1]
+            attmap[:, :, y0 // 4:y1 // 4, x0 // 4:x1 // 4] = tile_attmap[:, :, qy0:qy1, qx0:qx1]
+        return heatmap, descriptor, attmap
+
+
+def _adaptive_pool_matrix(in_size, out_size, device):
+    """
+    与AdaptiveAvgPool2d在一个维度上等价的[out_size,in_size]矩阵
+    """
+    weight = torch.zeros((out_size, in_size), device=device)
+    for i in range(out_size):
+        start = (i * in_size) // out_size
+        end = -((-(i + 1) * in_size) // out_size)  # ceil
+        weight[i, start:end] = 1. / (end - start)
+    return weight
+
+
+def _interpolate_matrix(in_size, out_size, device):
+    """
+    与f.interpolate(mode='bilinear', align_corners=False)在一个维度上等价的[out_size,in_size]矩阵
+    """
+    weight = torch.zeros((out_size, in_size), device=device)
+    scale = in_size / out_size
+    for i in range(out_size):
+        real = max(scale * (i + 0.5) - 0.5, 0.)
+        idx0 = min(int(real), in_size - 1)
+        idx1 = min(idx0 + 1, in_size - 1)
+        lam = real - idx0
+        weight[i, idx0] += 1. - lam
+        weight[i, idx1] += lam
+    return weight
@@ -76,6 +76,7 @@ def get_l16_config():
     config.transformer.num_layers = 12
     config.transformer.attention_dropout_rate = 0.0
     config.transformer.dropout_rate = 0.1
+    config.transformer.attention_backend = 'eager'  # eager or sdpa
     config.representation_size = None
 
     # custom
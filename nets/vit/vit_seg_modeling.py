@@ -82,6 +82,75 @@ class Attention(nn.Module):
         attention_output = self.out(context_layer)
         attention_output = self.proj_dropout(attention_output)
         return attention_output, weights
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 由FusedAttention保存的qkv参数拆分为query/key/value
+        for name in ['weight', 'bias']:
+            if prefix + 'qkv.' + name in state_dict:
+                query, key, value = state_dict.pop(prefix + 'qkv.' + name).chunk(3, dim=0)
+                state_dict[prefix + 'query.' + name] = query
+                state_dict[prefix + 'key.' + name] = key
+                state_dict[prefix + 'value.' + name] = value
+        super(Attention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class FusedAttention(nn.Module):
+    """
+    与Attention等价, query/key/value合并为一个Linear, 有scaled_dot_product_attention时(torch>=2.0)用其计算注意力,
+    否则退回显式的矩阵乘与softmax。可直接加载Attention的参数, 加载时将query/key/value拼接为qkv
+    """
+    def __init__(self, config, vis):
+        super(FusedAttention, self).__init__()
+        self.vis = vis
+        self.num_attention_heads = config.transformer["num_heads"]
+        self.attention_head_size = int(config.hidden_size / self.num_attention_heads)
+        self.all_head_size = self.num_attention_heads * self.attention_head_size
+
+        self.qkv = Linear(config.hidden_size, 3 * self.all_head_size)
+
+        self.out = Linear(config.hidden_size, config.hidden_size)
+        self.dropout_rate = config.transformer["attention_dropout_rate"]
+        self.attn_dropout = Dropout(self.dropout_rate)
+        self.proj_dropout = Dropout(self.dropout_rate)
+
+        self.softmax = Softmax(dim=-1)
+
+    def forward(self, hidden_states):
+        batch_size, seq_len = hidden_states.shape[0], hidden_states.shape[1]
+        mixed_layer = self.qkv(hidden_states)
+        mixed_layer = mixed_layer.view(batch_size, seq_len, 3, self.num_attention_heads, self.attention_head_size)
+        query_layer, key_layer, value_layer = mixed_layer.permute(2, 0, 3, 1, 4)  # [b,heads,n,head_size]
+
+        if self.vis or not hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            attention_probs = self.softmax(attention_scores)
+            weights = attention_probs if self.vis else None
+            attention_probs = self.attn_dropout(attention_probs)
+            context_layer = torch.matmul(attention_probs, value_layer)
+        else:
+            weights = None
+            context_layer = torch.nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer, dropout_p=self.dropout_rate if self.training else 0.)
+
+        context_layer = context_layer.transpose(1, 2).reshape(batch_size, seq_len, self.all_head_size)
+        attention_output = self.out(context_layer)
+        attention_output = self.proj_dropout(attention_output)
+        return attention_output, weights
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容Attention的checkpoint, 将query/key/value拼接为qkv
+        for name in ['weight', 'bias']:
+            if prefix + 'query.' + name in state_dict:
+                state_dict[prefix + 'qkv.' + name] = torch.cat([state_dict.pop(prefix + 'query.' + name),
+                                                                state_dict.pop(prefix + 'key.' + name),
+                                                                state_dict.pop(prefix + 'value.' + name)], dim=0)
+        super(FusedAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+ATTENTION_BACKENDS = {"eager": Attention, "sdpa": FusedAttention}
+
+
 class Mlp(nn.Module):
     def __init__(self, config):
         super(Mlp, self).__init__()
@@ -157,7 +226,7 @@ class Block(nn.Module):
         self.attention_norm = LayerNorm(config.hidden_size, eps=1e-6)
         self.ffn_norm = LayerNorm(config.hidden_size, eps=1e-6)
         self.ffn = Mlp(config)
-        self.attn = Attention(config, vis)
+        self.attn = ATTENTION_BACKENDS[config.transformer.get("attention_backend", "eager")](config, vis)
 
     def forward(self, x):
         h = x
@@ -184,13 +253,17 @@ class Block(nn.Module):
             value_bias = np2th(weights[pjoin(ROOT, ATTENTION_V, "bias")]).view(-1)
             out_bias = np2th(weights[pjoin(ROOT, ATTENTION_OUT, "bias")]).view(-1)
 
-            self.attn.query.weight.copy_(query_weight)
-            self.attn.key.weight.copy_(key_weight)
-            self.attn.value.weight.copy_(value_weight)
+            if isinstance(self.attn, FusedAttention):
+                self.attn.qkv.weight.copy_(torch.cat([query_weight, key_weight, value_weight], dim=0))
+                self.attn.qkv.bias.copy_(torch.cat([query_bias, key_bias, value_bias], dim=0))
+            else:
+                self.attn.query.weight.copy_(query_weight)
+                self.attn.key.weight.copy_(key_weight)
+                self.attn.value.weight.copy_(value_weight)
+                self.attn.query.bias.copy_(query_bias)
+                self.attn.key.bias.copy_(key_bias)
+                self.attn.value.bias.copy_(value_bias)
             self.attn.out.weight.copy_(out_weight)
-            self.attn.query.bias.copy_(query_bias)
-            self.attn.key.bias.copy_(key_bias)
-            self.attn.value.bias.copy_(value_bias)
             self.attn.out.bias.copy_(out_bias)
 
             mlp_weight_0 = np2th(weights[pjoin(ROOT, FC_0, "kernel")]).t()
@@ -449,3 +522,23 @@ CONFIGS = {
 }
 
 
+if __name__ == '__main__':
+    # CPU上对比两种注意力实现的PatchTransfomer延迟: python -m nets.vit.vit_seg_modeling
+    import time
+    torch.set_grad_enabled(False)
+    inputs = torch.randn(1, 128, 64, 64)
+    models = {}
+    for backend in ['eager', 'sdpa']:
+        config = configs.get_l16_config()
+        config.transformer.attention_backend = backend
+        models[backend] = PatchTransfomer(config=config, img_size=64, in_channels=128).eval()
+    # sdpa直接加载eager的参数
+    models['sdpa'].load_state_dict(models['eager'].state_dict())
+    print('max abs diff: %.2e' % (models['eager'](inputs) - models['sdpa'](inputs)).abs().max().item())
+    for backend, model in models.items():
+        for _ in range(10):
+            model(inputs)
+        start_time = time.time()
+        for _ in range(100):
+            model(inputs)
+        print('%s: %.3f ms' % (backend, (time.time() - start_time) * 10))
@@ -10,6 +10,8 @@ from torch.utils.data import DataLoader
 
 from nets import get_model
 from data_utils import get_dataset
+from data_utils.dataset_tools import unpack_bitmask
+from data_utils.batch_augmentation import BatchAugmentation
 from trainers.base_trainer import BaseTrainer
 from utils.utils import spatial_nms
 from utils.utils import AttentionWeightedTripletLoss
@@ -25,23 +27,42 @@ class MTLDescTrainer(BaseTrainer):
         self.logger.info('Initialize {}'.format(self.config['train']['dataset']))
         self.train_dataset = get_dataset(self.config['train']['dataset'])(**self.config['train'])
 
+        # 打包后的数据集按分片打乱, 使读取集中在同一个分片内
+        sampler = None
+        if hasattr(self.train_dataset, 'shard_sampler'):
+            sampler = self.train_dataset.shard_sampler()
+
         self.train_dataloader = DataLoader(
             dataset=self.train_dataset,
             batch_size=self.config['train']['batch_size'],
-            shuffle=True,
+            shuffle=sampler is None,
+            sampler=sampler,
             num_workers=self.config['train']['num_workers'],
+            collate_fn=getattr(self.train_dataset, 'collate_fn', None),
             drop_last=True
         )
         self.epoch_length = len(self.train_dataset) // self.config['train']['batch_size']
 
+        # worker中不做光度与单应增强, 拷贝到GPU后对整个batch增强
+        self.batch_augmentation = None
+        if self.config['train'].get('gpu_augmentation', False):
+            self.logger.info('Initialize BatchAugmentation on {}'.format(self.device))
+            self.batch_augmentation = BatchAugmentation(
+                self.device, self.config['train']['height'], self.config['train']['width'])
+
     def _initialize_model(self):
         self.logger.info("Initialize network arch {}".format(self.config['model']['backbone']))
-        model = get_model(self.config['model']['backbone'])()
+        model = get_model(self.config['model']['backbone'])(**self._model_kwargs())
 
         if self.multi_gpus:
             model = torch.nn.DataParallel(model)
         self.model = model.to(self.device)
 
+    def _model_kwargs(self):
+        # 全局上下文transformer的结构, 未设置时与原始模型一致
+        keys = ['attention_backend', 'context_layers', 'context_mlp_dim']
+        return {k: self.config['model'][k] for k in keys if k in self.config['model']}
+
     def _initialize_loss(self):
         self.logger.info("Initialize the PointHeatmapWeightedBCELoss.")
         self.point_loss = PointHeatmapWeightedBCELoss(weight=self.config['train']['point_loss_weight'])
@@ -77,24 +98,38 @@ class MTLDescTrainer(BaseTrainer):
         self.logger.info("Training epoch %2d done." % epoch_idx)
         self.logger.info("-----------------------------------------------------")
 
+    def _prepare_batch(self, data):
+        """
+        将batch拷贝到训练设备上, 展开位图形式的not_search_mask, 并在gpu_augmentation模式下做batch增强
+        """
+        data = {key: value.to(self.device) for key, value in data.items()}
+        if "not_search_bits" in data:
+            # 以位图传输, 在GPU上展开为[b,n,n]
+            data["not_search_mask"] = unpack_bitmask(data["not_search_bits"], data["valid_mask"].shape[1])
+        if self.batch_augmentation is not None:
+            data = self.batch_augmentation(data)
+        return data
+
     def _train_func(self, epoch_idx):
         self.model.train()
         stime = time.time()
         total_loss = 0
         for i, data in enumerate(self.train_dataloader):
 
-            image = data["image"].to(self.device)
-            heatmap_gt = data['heatmap'].to(self.device)
-            point_mask = data['point_mask'].to(self.device)
-            desp_point = data["desp_point"].to(self.device)
+            data = self._prepare_batch(data)
+
+            image = data["image"]
+            heatmap_gt = data['heatmap']
+            point_mask = data['point_mask']
+            desp_point = data["desp_point"]
 
-            warped_image = data["warped_image"].to(self.device)
-            warped_heatmap_gt = data['warped_heatmap'].to(self.device)
-            warped_point_mask = data['warped_point_mask'].to(self.device)
-            warped_desp_point = data["warped_desp_point"].to(self.device)
+            warped_image = data["warped_image"]
+            warped_heatmap_gt = data['warped_heatmap']
+            warped_point_mask = data['warped_point_mask']
+            warped_desp_point = data["warped_desp_point"]
 
-            valid_mask = data["valid_mask"].to(self.device)
-            not_search_mask = data["not_search_mask"].to(self.device)
+            valid_mask = data["valid_mask"]
+            not_search_mask = data["not_search_mask"]
             image_pair = torch.cat((image, warped_image), dim=0)
             heatmap_pred_pair, feature, weight_map = self.model(image_pair)
             desp_point_pair = torch.cat((desp_point, warped_desp_point), dim=0)
@@ -138,6 +173,8 @@ class MTLDescTrainer(BaseTrainer):
                     ))
                 stime = time.time()
         self.logger.info("Total_loss:" + str(total_loss.detach().cpu().numpy()))
+        if self.batch_augmentation is not None:
+            self.logger.info("Homography acceptance: {}".format(self.batch_augmentation.homography.acceptance_stats()))
         # save the model
         if self.multi_gpus:
             torch.save(
@@ -194,3 +231,109 @@ class MTLDescTrainer(BaseTrainer):
 
         return desp
 
+
+class ContextDistillTrainer(MTLDescTrainer):
+    """
+    将已有checkpoint(教师)的全局上下文transformer蒸馏到层数更少、MLP更窄的transformer(学生)。
+    学生除transformer以外的参数直接拷贝自教师并固定; transformer的第j层由教师中均匀间隔的一层初始化,
+    MLP变窄时保留教师中|fc1行|*|fc2列|最大的隐藏单元。训练时以教师在同一adapool特征上的transformer输出为目标做MSE回归
+    """
+
+    def _initialize_model(self):
+        backbone = self.config['model']['backbone']
+        model_kwargs = self._model_kwargs()
+        teacher_ckpt = self.config['train']['teacher_ckpt']
+        self.logger.info("Initialize teacher network %s from %s" % (backbone, teacher_ckpt))
+        teacher_kwargs = {k: v for k, v in model_kwargs.items() if k == 'attention_backend'}
+        teacher = get_model(backbone)(**teacher_kwargs)
+        teacher.load_state_dict(torch.load(teacher_ckpt, map_location='cpu'))
+        for param in teacher.parameters():
+            param.requires_grad = False
+        self.teacher = teacher.to(self.device).eval()
+
+        self.logger.info("Initialize student network %s with %s" % (backbone, model_kwargs))
+        student = get_model(backbone)(**model_kwargs)
+        self._init_student(student, teacher)
+        for name, param in student.named_parameters():
+            param.requires_grad = name.startswith('transfomer.')
+        # transformer只有16个token, 不需要多卡
+        self.multi_gpus = False
+        self.model = student.to(self.device)
+
+    @staticmethod
+    def _init_student(student, teacher):
+        teacher_dict = teacher.state_dict()
+        student_dict = student.state_dict()
+        num_teacher = len(teacher.transfomer.encoder.layer)
+        num_student = len(student.transfomer.encoder.layer)
+        layer_map = [int(round(j * (num_teacher - 1) / max(num_student - 1, 1))) for j in range(num_student)]
+
+        prefix = 'transfomer.encoder.layer.'
+        for key in student_dict:
+            src = key
+            if key.startswith(prefix):
+                idx, rest = key[len(prefix):].split('.', 1)
+                src = prefix + str(layer_map[int(idx)]) + '.' + rest
+            if src in teacher_dict and teacher_dict[src].shape == student_dict[key].shape:
+                student_dict[key] = teacher_dict[src].clone()
+
+        # MLP变窄时裁剪教师的隐藏单元
+        for j, t in enumerate(layer_map):
+            student_ffn = prefix + '%d.ffn.' % j
+            teacher_ffn = prefix + '%d.ffn.' % t
+            fc1_weight = teacher_dict[teacher_ffn + 'fc1.weight']  # [mlp_dim,hidden]
+            fc2_weight = teacher_dict[teacher_ffn + 'fc2.weight']  # [hidden,mlp_dim]
+            mlp_dim = student_dict[student_ffn + 'fc1.weight'].shape[0]
+            if mlp_dim >= fc1_weight.shape[0]:
+                continue
+            importance = torch.norm(fc1_weight, dim=1) * torch.norm(fc2_weight, dim=0)
+            keep = torch.sort(torch.topk(importance, mlp_dim)[1])[0]
+            student_dict[student_ffn + 'fc1.weight'] = fc1_weight[keep].clone()
+            student_dict[student_ffn + 'fc1.bias'] = teacher_dict[teacher_ffn + 'fc1.bias'][keep].clone()
+            student_dict[student_ffn + 'fc2.weight'] = fc2_weight[:, keep].clone()
+        student.load_state_dict(student_dict)
+
+    def _initialize_optimizer(self):
+        self.logger.info("Initialize Adam optimizer for the context transformer with weight_decay: {:.5f}.".format(
+            self.config['train']['weight_decay']))
+        self.optimizer = torch.optim.Adam(
+            params=[param for param in self.model.parameters() if param.requires_grad],
+            lr=self.config['train']['lr'],
+            weight_decay=self.config['train']['weight_decay'])
+
+    def _initialize_loss(self):
+        self.logger.info("Initialize the MSELoss for context distillation.")
+        self.distill_loss = torch.nn.MSELoss()
+
+    def _train_func(self, epoch_idx):
+        self.model.train()
+        stime = time.time()
+        total_loss = 0
+        for i, data in enumerate(self.train_dataloader):
+            # 与MTLDescTrainer相同的数据准备, gpu_augmentation时学生与教师看到的是增强后的图像
+            data = self._prepare_batch(data)
+            image_pair = torch.cat((data["image"], data["warped_image"]), dim=0)
+
+            # 学生除transformer外与教师相同, 直接使用教师的adapool特征
+            with torch.no_grad():
+                c4 = self.teacher._encode(image_pair)[3]
+                top = self.teacher.adapool(c4)
+                target = self.teacher.transfomer(top)
+            context = self.model.transfomer(top)
+            loss = self.distill_loss(context, target)
+            total_loss += loss.item()
+
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+
+            if i % self.config['train']['log_freq'] == 0:
+                self.logger.info(
+                    "[Epoch:%2d][Step:%5d:%5d]: distill_loss = %.6f, one step cost %.4fs. " % (
+                        epoch_idx, i, self.epoch_length, loss.item(),
+                        (time.time() - stime) / self.config['train']['log_freq'],
+                    ))
+                stime = time.time()
+        self.logger.info("Total_loss:" + str(total_loss))
+        # save the model
+        torch.save(self.model.state_dict(), os.path.join(self.config['ckpt_path'], 'model_%02d.pt' % epoch_idx))